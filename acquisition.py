@@ -0,0 +1,118 @@
+import time
+import threading
+
+from sensors import createsource, SensorSource
+from util import ReconnectPolicy
+
+
+class SensorAcquisition(threading.Thread):
+    """Reads the sensor source on its own thread, so that a slow or hung source (the WMI query of Libre Hardware
+       Monitor takes ~40 ms) holds up neither the control cycle nor settings updates from the UI.
+
+       Double buffering: the source is the back buffer, its readings change while update() runs. Once a sample
+       is complete it is copied into an immutable SensorSnapshot, the front buffer, which replaces self.latest
+       in a single assignment. Readers take self.latest without a lock and without waiting, and always get
+       a complete sample along with its timestamp.
+
+       The source is created, connected, read and closed on this thread only, as WMI (COM) requires.
+       Only the sensors the signals need are read (see demand()), unless all of them are wanted for display."""
+
+    PERIOD = 1.0      # seconds between samples
+
+    def __init__(self, config, selectors=None, createsource=createsource):
+        threading.Thread.__init__(self, name="SensorAcquisition", daemon=True)
+        self.config = config                # the "sensors" settings the source should be created with
+        self.selectors = selectors          # the sensors to read, None for all, see demand()
+        self.createsource = createsource
+        self.source = None                  # only touched by this thread
+        self.sourceconfig = None
+        self.policy = ReconnectPolicy()
+        self.latest = errorsnapshot("Waiting for sensor readings...")  # the front buffer
+        self.published = threading.Event()  # set once the first sample is published
+        self.wakeup = threading.Event()
+        self.shutdown = False
+
+    def configure(self, config):
+        """Changes the "sensors" settings, the source is recreated on the next sample if they differ"""
+        self.config = config
+        self.wakeup.set()
+
+    def demand(self, selectors):
+        """Sets the sensors to read as a list of selectors like those of signals ("device, sensor" or "device"),
+           None reads all of them. A change is applied with a new sample right away"""
+        if (selectors != self.selectors):
+            self.selectors = None if selectors is None else list(selectors)
+            self.wakeup.set()
+
+    def kick(self):
+        """Retries a source that is offline right away instead of waiting for the backoff to expire"""
+        self.policy.kick()
+        self.wakeup.set()
+
+    def status(self):
+        """Describes the state of the reconnect attempts for the UI"""
+        return self.policy.status()
+
+    def sample(self):
+        """Reads the source once and publishes the readings"""
+        config = self.config
+        if (self.source is None and config == self.sourceconfig and not self.policy.ready()):
+            return      # the source has failed, it is recreated once the backoff delay expires
+        if (self.source is None or config != self.sourceconfig):
+            if (self.source): self.source.close()
+            self.source = None
+            self.sourceconfig = config      # before it may fail, so that the next attempt waits for the backoff
+            self.source = self.createsource({"sensors": config})
+            self.policy.result(self.source.initialized)
+        elif (not self.source.initialized and self.policy.ready()):
+            # the sensor source (e.g. Libre Hardware Monitor) may start later than the app or be restarted at any time
+            self.source.connect()
+            self.policy.result(self.source.initialized)
+        selectors = self.selectors
+        if (selectors != self.source.selectors):
+            self.source.select(selectors)
+        self.source.update()
+        self.latest = self.source.snapshot(time.monotonic())
+        self.published.set()
+
+    def failed(self, e):
+        """Publishes the error of a sample that has raised an exception, the source is closed and recreated
+           after the backoff delay"""
+        print ("Sensor acquisition has failed: {0}".format(repr(e)))
+        source = self.source
+        self.source = None
+        self.policy.result(False)
+        if (source):
+            try:
+                source.close()
+            except Exception:
+                pass
+        self.latest = errorsnapshot("Error: Sensor source has failed. {0}".format(repr(e)))
+        self.published.set()
+
+    def run(self):
+        """threadproc"""
+        while not self.shutdown:
+            self.wakeup.clear()
+            try:
+                self.sample()
+            except Exception as e:
+                # e.g. a source that cannot be created from its settings, the thread has to go on anyway
+                self.failed(e)
+            self.wakeup.wait(self.PERIOD)
+        if (self.source): self.source.close()
+
+    def stop(self, timeout=5.0):
+        """Stops the thread. A source that hangs is left behind, the thread is a daemon"""
+        self.shutdown = True
+        self.wakeup.set()
+        self.join(timeout)
+
+
+
+def errorsnapshot(message):
+    """Returns an empty SensorSnapshot that is not ok, with the error message"""
+    snapshot = SensorSource().snapshot()
+    snapshot.ok = False
+    snapshot.errorMessage = message
+    return snapshot
@@ -0,0 +1,731 @@
+"""Performance benchmarks and soak tests that run against an emulated Grid, no hardware required.
+
+   Usage: python benchmark.py [acquisition] [aggregator] [codec] [discover] [hotplug] [http] [hwmon] [poll] [process] [signals] [snapshot] [write] [priority] [soak] [--latency MS] [--rounds N] [--pty]
+                              [--duration SEC] [--droprate P] [--strayrate P] [--trace FILE]
+"""
+import time
+import os
+import random
+import timeit
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import json
+import gzip
+import threading
+import queue
+import http.server
+import socketserver
+import urllib.request
+
+import serial
+
+import gridproto
+from hardware import NZXTGrid
+from gridemu import EmulatedSerial, PtyGrid
+from gridio import GridWorker, TELEMETRY, WRITE
+from gridtrace import readtrace, tracelatency
+from discovery import probe, probeall
+from hotplug import HotplugWatcher
+from sensorprocess import SensorProcess
+from sensors import HwmonSource, HttpSource, SensorSource, SensorAggregator, Signal
+from acquisition import SensorAcquisition
+
+
+def emulatedgrid(args):
+    """Returns NZXTGrid connected to an emulated Grid, either in-process or through a pseudo-terminal"""
+    faults = dict(latency=args.latency / 1000.0, droprate=args.droprate, strayrate=args.strayrate, seed=args.seed)
+    if (args.trace):
+        faults["latency"] = tracelatency(readtrace(args.trace))   # per command, as measured on a real Grid
+    grid = NZXTGrid()
+    if (args.pty):
+        grid.emulator = PtyGrid(**faults)
+        grid.open(grid.emulator.start())
+    else:
+        grid.emulator = None
+        grid.com = EmulatedSerial(**faults)
+        grid.open("EMULATED")
+    grid.hello()
+    return grid
+
+
+def latencytext(args):
+    if (args.trace): return "device latency from {0}".format(args.trace)
+    return "device latency {0} ms".format(args.latency)
+
+
+def closegrid(grid):
+    grid.close()
+    if (grid.emulator): grid.emulator.stop()
+
+
+def measure(fn, rounds):
+    """Runs fn a number of times, returns (min, average) execution time in msec"""
+    times = []
+    for i in range(0, rounds):
+        t = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t) * 1000)
+    return min(times), sum(times) / len(times)
+
+
+def bench_acquisition(args):
+    """Time the control cycle spends on sensors with a source that takes 40 ms per sample (like the WMI query):
+       reading the source in the cycle vs. taking the latest snapshot of SensorAcquisition"""
+    class SlowSource(SensorSource):
+        NAME = "slow source"
+        def __init__(self, settings):
+            self.setreadings([("/intelcpu/0", "CPU Core #{0}".format(n), 50) for n in range(1, 9)])
+            self.initialized = True
+        def update(self):
+            time.sleep(0.04)
+
+    signals = {"cpu": Signal("cpu", "max", ["/intelcpu/0"])}
+    cycles = 20
+    print("Sensor time per control cycle, source takes 40 ms per sample, {0} cycles:".format(cycles))
+
+    source = SlowSource(None)
+    def synchronous():
+        source.update()
+        source.snapshot().updateSignals(signals)
+
+    acquisition = SensorAcquisition({}, createsource=SlowSource)
+    acquisition.PERIOD = 0.05
+    acquisition.start()
+    acquisition.published.wait()
+
+    synctime = measure(synchronous, cycles)[1]
+    threadedtime = 0
+    ages = []
+    for i in range(0, cycles):
+        ages.append(acquisition.latest.age() * 1000)
+        threadedtime += measure(lambda: acquisition.latest.updateSignals(signals), 1)[1]
+        time.sleep(0.01)    # the rest of the cycle, the snapshot changes meanwhile
+    acquisition.stop()
+    print("  in the cycle: {0:7.3f} ms   snapshot: {1:7.3f} ms   speedup: {2:.0f}x".format(
+        synctime, threadedtime / cycles, synctime / (threadedtime / cycles)))
+    print("  snapshot age: {0:.1f} .. {1:.1f} ms".format(min(ages), max(ages)))
+
+
+def bench_aggregator(args):
+    """Four sensor backends of which one takes 200 ms per sample and one hangs for good after its first sample:
+       reading them one after another vs. SensorAggregator with a 50 ms deadline per backend"""
+    class DelayedSource(SensorSource):
+        def __init__(self, config):
+            self.NAME = config["device"]
+            self.delay = config["delay"]
+            self.hang = config.get("hang", self.delay)
+            self.connect()
+        def connect(self):
+            self.setreadings([(self.NAME, "Temp #{0}".format(n), 40) for n in range(1, 9)])
+            self.initialized = True
+            self.ok = True
+        def update(self):
+            time.sleep(self.delay)
+            self.delay = self.hang
+
+    config = {
+        "cpu": {"device": "/intelcpu/0", "delay": 0.001, "timeout": 50},
+        "gpu": {"device": "/nvidiagpu/0", "delay": 0.002, "timeout": 50},
+        "disk": {"device": "/hdd/0", "delay": 0.2, "timeout": 50},
+        "hung": {"device": "/hdd/1", "delay": 0, "hang": 3600, "timeout": 50}}
+    rounds = 10
+    print("Sample of 4 sensor backends, one takes 200 ms and one hangs, {0} samples:".format(rounds))
+
+    sources = [DelayedSource(c) for name, c in config.items() if name != "hung"]
+    def sequential():
+        for source in sources: source.update()
+    sequentialtime = measure(sequential, rounds)[1]
+
+    aggregator = SensorAggregator(config, createsource=lambda settings: DelayedSource(settings["sensors"]))
+    for backend in aggregator.backends:
+        backend.sample().result()   # the first sample of every backend, the hung one hangs from now on
+    times = measure(aggregator.update, rounds)
+    snapshot = aggregator.snapshot()
+    stale = len([x for x in snapshot if x.stale is not None])
+    print("  one after another (without the hung one): {0:7.3f} ms".format(sequentialtime))
+    print("  SensorAggregator: {0:7.3f} ms   speedup: {1:.1f}x   stale sensors: {2} of {3}".format(
+        times[1], sequentialtime / times[1], stale, len(snapshot)))
+    aggregator.close()
+
+
+def bench_codec(args):
+    """Per-frame cost of building requests and parsing responses, without any I/O:
+       command lists converted with serial.to_bytes() and checked with int("0x..", 16) as the original code did,
+       vs. the pre-encoded frames and struct based decoding of gridproto"""
+    number = 20000
+    fanids = list(range(1, NZXTGrid.NUM_FANS+1))
+    codes = [gridproto.CMD_RPM, gridproto.CMD_VOLTAGE]
+    reading = b"\xC0\x00\x00\x05\x28"
+    stream = reading * (len(fanids) * len(codes))
+
+    def legacyrequest():
+        cmd = []
+        for fanid in fanids:
+            for code in codes:
+                cmd.extend([code, fanid])
+        return serial.to_bytes(cmd)
+
+    def legacydecode():
+        res = []
+        for i in range(0, len(stream) // 5):
+            chunk = stream[i*5:i*5+5]
+            if (chunk[0]) == int("0xC0", 16) and (chunk[1]) == int("0x00", 16) and (chunk[2]) == int("0x00", 16):
+                res.append(int(chunk[3])*256 + int(chunk[4]))
+        return res
+
+    def codecdecode():
+        return [gridproto.decodereading(gridproto.CMD_RPM, high, low)
+                for high, low in gridproto.decodereadings(stream, len(stream) // 5)]
+
+    if (legacyrequest() != gridproto.pollrequest(fanids, codes) or legacydecode() != codecdecode()):
+        print("  codec output differs from the legacy encoding")
+
+    frames = len(fanids) * len(codes)
+    # (name, frames handled per call, legacy, codec)
+    cases = [
+        ("build poll request", frames, legacyrequest, lambda: gridproto.pollrequest(fanids, codes)),
+        ("build speed command", 1, lambda: serial.to_bytes([0x44, 1, 0xC0, 0x00, 0x00, 7, 20]),
+                                   lambda: gridproto.speedframe(1, 60)),
+        ("decode readings", frames, legacydecode, codecdecode),
+        ("split response stream", frames, None, lambda: gridproto.splitframes(stream, gridproto.READING)),
+    ]
+    print("Codec overhead per frame, {0} frames per poll, {1} iterations:".format(frames, number))
+    for name, n, legacy, codec in cases:
+        codectime = timeit.timeit(codec, number=number) / number / n * 1e6
+        if (legacy is None):
+            print("  {0:22} codec: {1:6.3f} us".format(name, codectime))
+            continue
+        legacytime = timeit.timeit(legacy, number=number) / number / n * 1e6
+        print("  {0:22} legacy: {1:6.3f} us   codec: {2:6.3f} us   speedup: {3:.1f}x".format(
+            name, legacytime, codectime, legacytime / codectime))
+    # for scale: a 5-byte response alone takes this long on the wire
+    print("  line time of one reading at 4800 baud: {0:.0f} us".format(5 * 10.0 / 4800 * 1e6))
+
+
+def bench_discover(args):
+    """Grid autodiscovery: one Grid among several silent serial ports, probed one after another vs. in parallel.
+       Needs pseudo-terminals (POSIX only)"""
+    import tty
+    emulator = PtyGrid(latency=args.latency / 1000.0)
+    ports = [emulator.start()]
+    silent = []
+    for i in range(0, 5):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        silent.extend([master, slave])
+        ports.append(os.ttyname(slave))
+    print("Grid autodiscovery among {0} ports, {1} rounds:".format(len(ports), args.rounds))
+    if (probeall(ports) != ports[0:1]):
+        print("  parallel probe did not find the emulated Grid")
+    sequential = measure(lambda: [probe(port) for port in ports], args.rounds)
+    parallel = measure(lambda: probeall(ports), args.rounds)
+    print("  one by one: {0:6.1f} ms   parallel: {1:6.1f} ms   speedup: {2:.2f}x".format(
+        sequential[1], parallel[1], sequential[1] / parallel[1]))
+    emulator.stop()
+    for fd in silent: os.close(fd)
+
+
+def fakehwmon(root, devices, sensors):
+    """Creates a fake /sys/class/hwmon tree: devices x sensors temperature inputs"""
+    drivers = ["coretemp", "amdgpu", "nvme", "nvme", "drivetemp", "acpitz"]
+    for d in range(0, devices):
+        path = os.path.join(root, "hwmon{0}".format(d))
+        os.makedirs(path)
+        with open(os.path.join(path, "name"), "w") as f: f.write(drivers[d % len(drivers)] + "\n")
+        for n in range(1, sensors+1):
+            with open(os.path.join(path, "temp{0}_input".format(n)), "w") as f: f.write("{0}\n".format(30000 + 500*n))
+            with open(os.path.join(path, "temp{0}_label".format(n)), "w") as f: f.write("Core {0}\n".format(n-1))
+
+
+def fakelhmtree(hardware, sensors, seed=0):
+    """Returns a data.json tree as served by Libre Hardware Monitor: hardware x sensor groups x sensors"""
+    rnd = random.Random(seed)
+    groups = [("Voltages", "Voltage", "V"), ("Clocks", "Clock", "MHz"), ("Temperatures", "Temperature", "\u00b0C"),
+              ("Load", "Load", "%"), ("Fans", "Fan", "RPM"), ("Powers", "Power", "W")]
+    ids = iter(range(1, 1000000))
+    computer = {"id": next(ids), "Text": "BENCHMARK", "Min": "", "Value": "", "Max": "", "ImageURL": "images_icon/computer.png", "Children": []}
+    for h in range(0, hardware):
+        identifier = "/{0}/{1}".format(["intelcpu", "nvidiagpu", "lpc/nct6798d", "hdd", "ram"][h % 5], h // 5)
+        node = {"id": next(ids), "Text": "Device {0}".format(h), "Min": "", "Value": "", "Max": "", "ImageURL": "images_icon/chip.png", "Children": []}
+        for group, type, unit in groups:
+            groupnode = {"id": next(ids), "Text": group, "Min": "", "Value": "", "Max": "", "ImageURL": "images_icon/sensor.png", "Children": []}
+            for n in range(0, sensors):
+                value = "{0:.1f} {1}".format(30 + rnd.random() * 40, unit)
+                groupnode["Children"].append({"id": next(ids), "Text": "{0} #{1}".format(type, n+1), "Min": value, "Value": value,
+                    "Max": value, "SensorId": "{0}/{1}/{2}".format(identifier, type.lower(), n), "Type": type,
+                    "ImageURL": "images/transparent.png", "Children": []})
+            node["Children"].append(groupnode)
+        computer["Children"].append(node)
+    return {"id": 0, "Text": "Sensor", "Min": "Min", "Value": "Value", "Max": "Max", "ImageURL": "", "Children": [computer]}
+
+
+class FakeLhm(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Serves trees of fakelhmtree() on 127.0.0.1 like the Libre Hardware Monitor web server, with keep-alive,
+       gzip and ETags. The tree served is trees[version], set version to change it."""
+    daemon_threads = True
+    version = 0
+
+    def __init__(self, trees):
+        http.server.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeLhmHandler)
+        # (plain, gzipped) bodies, encoded up front so that the server costs little compared to the client
+        self.bodies = []
+        for tree in trees:
+            body = json.dumps(tree).encode("utf-8")
+            self.bodies.append((body, gzip.compress(body)))
+        self.url = "http://127.0.0.1:{0}/data.json".format(self.server_address[1])
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeLhmHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        version = self.server.version
+        etag = '"{0}"'.format(version)
+        if (self.headers.get("If-None-Match") == etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        plain, zipped = self.server.bodies[version]
+        compressed = "gzip" in self.headers.get("Accept-Encoding", "")
+        body = zipped if compressed else plain
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        if (compressed): self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_hotplug(args):
+    """Unplugging and replugging a Grid behind a PTY symlink: the watcher has to notice the symlink go away and come
+       back, the Grid has to go offline and be reconnected. Needs pseudo-terminals (POSIX only)"""
+    emulator = PtyGrid(latency=args.latency / 1000.0)
+    folder = tempfile.mkdtemp()
+    port = os.path.join(folder, "ttyGrid")
+    os.symlink(emulator.start(), port)
+    grid = NZXTGrid()
+    grid.open(port)
+    if grid.ok: grid.hello()
+    assert grid.ok, "the emulated Grid does not answer at {0}".format(port)
+
+    events = queue.Queue()
+    def hotplugged(changed, present):
+        if (not present): grid.detach()    # like the controller does on the worker of the Grid
+        events.put((changed, present, time.perf_counter()))
+    watcher = HotplugWatcher(hotplugged)
+    watcher.watch([port])
+    watcher.start()
+    timeout = 4 * HotplugWatcher.PERIOD
+    print("Hotplug of a Grid behind a PTY symlink, {0} rounds:".format(args.rounds))
+    unplugged = []
+    replugged = []
+    for i in range(0, args.rounds):
+        t = time.perf_counter()
+        os.remove(port)
+        event = events.get(timeout=timeout)
+        assert event[0:2] == (port, False), "unplugging was not noticed: {0}".format(event)
+        assert not grid.ok, "the unplugged Grid is still online"
+        assert not watcher.present(port), "the watcher still reports the unplugged Grid as present"
+        unplugged.append((event[2] - t) * 1000)
+
+        t = time.perf_counter()
+        os.symlink(emulator.port, port)
+        event = events.get(timeout=timeout)
+        assert event[0:2] == (port, True), "replugging was not noticed: {0}".format(event)
+        grid.close()
+        grid.open(port)
+        if grid.ok: grid.hello()
+        if grid.ok: grid.poll(pollrpm=True, pollvoltage=True, pollamperage=False)
+        assert grid.ok, "the replugged Grid has not been reconnected: {0}".format(grid.errorMessage)
+        replugged.append((time.perf_counter() - t) * 1000)
+    watcher.stop()
+    assert events.empty(), "unexpected hotplug events: {0}".format(list(events.queue))
+    print("  noticed unplugged: {0:6.1f} ms   reconnected after replug: {1:6.1f} ms   (average, watcher period {2} ms)".format(
+        sum(unplugged) / len(unplugged), sum(replugged) / len(replugged), int(HotplugWatcher.PERIOD * 1000)))
+    grid.close()
+    emulator.stop()
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_http(args):
+    """Libre Hardware Monitor web server: a new connection and the whole tree parsed per sample vs. HttpSource,
+       with a kept-alive connection, parsing only the temperatures and conditional requests"""
+    trees = [fakelhmtree(10, 8, seed) for seed in range(0, 4)]
+    server = FakeLhm(trees)
+    number = 200
+
+    def legacy():
+        with urllib.request.urlopen(server.url) as response:
+            tree = json.loads(response.read().decode("utf-8"))
+        res = []
+        nodes = [tree]
+        while nodes:
+            node = nodes.pop()
+            if (node.get("Type") == "Temperature"): res.append(node)
+            nodes.extend(node.get("Children", []))
+        return res
+
+    source = HttpSource(server.url)
+    if (not source.initialized or len(source.catalog) != len(legacy())):
+        print("  HttpSource read {0} sensors, expected {1}".format(len(source.catalog), len(legacy())))
+    plain, zipped = server.bodies[0]
+    print("data.json of {0} temperatures among {1} sensors, {2} KB ({3} KB gzipped), {4} samples:".format(
+        len(source.catalog), 10 * 8 * 6, len(plain) // 1024, len(zipped) // 1024, number))
+
+    def changed():
+        server.version = (server.version + 1) % len(trees)
+        source.update()
+
+    legacytime = timeit.timeit(legacy, number=number) / number * 1000
+    changedtime = timeit.timeit(changed, number=number) / number * 1000
+    unchangedtime = timeit.timeit(source.update, number=number) / number * 1000
+    print("  new connection, whole tree: {0:6.3f} ms".format(legacytime))
+    print("  HttpSource, changed tree:   {0:6.3f} ms   speedup: {1:.1f}x".format(changedtime, legacytime / changedtime))
+    print("  HttpSource, unchanged tree: {0:6.3f} ms   speedup: {1:.1f}x".format(unchangedtime, legacytime / unchangedtime))
+    source.close()
+    server.stop()
+
+
+def bench_hwmon(args):
+    """hwmon sensor acquisition: opening and reading every file per sample vs. pread() on files kept open,
+       and pread() of only the sensors a CPU and a GPU signal need"""
+    root = tempfile.mkdtemp(prefix="hwmon")
+    fakehwmon(root, 16, 12)
+    number = 1000
+    source = HwmonSource(root)
+    print("hwmon acquisition of {0} sensors, {1} samples:".format(len(source.catalog), number))
+
+    paths = [os.path.join(root, hwmon, entry) for hwmon in sorted(os.listdir(root))
+             for entry in sorted(os.listdir(os.path.join(root, hwmon))) if entry.endswith("_input")]
+
+    def reopen():
+        for path in paths:
+            with open(path, "r") as f:
+                value = int(f.read()) / 1000.0
+
+    reopened = timeit.timeit(reopen, number=number) / number * 1000
+    kept = timeit.timeit(source.update, number=number) / number * 1000
+    print("  open/read/close: {0:6.3f} ms   pread: {1:6.3f} ms   speedup: {2:.1f}x".format(reopened, kept, reopened / kept))
+    source.select(["coretemp", "amdgpu, Core 0"])
+    demanded = timeit.timeit(source.update, number=number) / number * 1000
+    print("  pread of the {0} sensors signals need: {1:6.3f} ms   speedup: {2:.1f}x".format(
+        len(source.catalog), demanded, reopened / demanded))
+    source.close()
+    shutil.rmtree(root)
+
+
+class LegacySensor():
+    """Sensor reading as it was kept before snapshots: one object per reading and sample"""
+    def __init__(self, parent, name, value):
+        self.parent = parent
+        self.name = name
+        self.value = value
+
+
+def sensorcatalog():
+    """Returns (parent, name) of 160 sensors like Libre Hardware Monitor reports them"""
+    devices = ["/intelcpu/0", "/gpu-nvidia/0", "/hdd/0", "/hdd/1", "/nvme/0", "/lpc/nct6798d", "/ram", "/battery"]
+    return [(device, "Core #{0}".format(n)) for device in devices for n in range(0, 20)]
+
+
+def allocations(fn, number):
+    """Returns the nr of memory blocks fn allocates per call, not counting those freed again"""
+    fn()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(0, number): fn()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum([stat.count_diff for stat in after.compare_to(before, "filename")]) / float(number)
+
+
+class BusySource(SensorSource):
+    """Sensor source that keeps the CPU busy in Python for "busy" msec per sample, like the WMI query does while
+       it turns the COM objects of 160 sensors into Python ones"""
+    NAME = "busy source"
+
+    def __init__(self, settings):
+        self.busy = settings["sensors"]["busy"] / 1000.0
+        self.setreadings([(parent, name, 40) for parent, name in sensorcatalog()])
+        self.initialized = True
+        self.ok = True
+
+    def update(self):
+        end = time.perf_counter() + self.busy
+        while time.perf_counter() < end: pass
+
+
+def bench_process(args):
+    """Time the control cycle takes for its own (Python) work while sensors are read by a source that keeps
+       the CPU busy for 40 ms per sample: SensorAcquisition on a thread (sharing the GIL) vs. SensorProcess"""
+    signals = {"cpu": Signal("cpu", "max", ["/intelcpu/0"]), "gpu": Signal("gpu", "avg", ["/nvidiagpu/0"])}
+    config = {"busy": 40}
+    number = 200
+    print("Control cycle work while a source is busy for 40 ms per sample, {0} cycles, {1} CPUs:".format(number, os.cpu_count()))
+
+    def cycles(acquisition):
+        acquisition.PERIOD = 0.05 if type(acquisition) is SensorAcquisition else acquisition.PERIOD
+        acquisition.start()
+        acquisition.published.wait(10)
+        def cycle():
+            for i in range(0, 100): acquisition.latest.updateSignals(signals)
+        times = [measure(cycle, 1)[1] for i in range(0, number)]
+        acquisition.stop()
+        times.sort()
+        return sum(times) / len(times), times[int(len(times) * 0.99)]
+
+    source = BusySource({"sensors": config})
+    snapshot = source.snapshot()
+    idle = measure(lambda: [snapshot.updateSignals(signals) for i in range(0, 100)], number)[1]
+    threaded = cycles(SensorAcquisition(config, createsource=BusySource))
+    SensorProcess.SAMPLE_PERIOD = 0.05
+    separate = cycles(SensorProcess(config, createsource=BusySource))
+    print("  no acquisition:          {0:7.3f} ms".format(idle))
+    print("  thread:  average {0:7.3f} ms   99th percentile {1:7.3f} ms".format(*threaded))
+    print("  process: average {0:7.3f} ms   99th percentile {1:7.3f} ms   speedup: {2:.1f}x".format(
+        separate[0], separate[1], threaded[0] / separate[0]))
+
+
+def bench_signals(args):
+    """Signal evaluation: scanning all sensors for every selector vs. selectors compiled into sensor slots"""
+    catalog = sensorcatalog()
+    signals = {
+        "CPU": Signal("CPU", "max", ["/intelcpu/0"]),
+        "GPU": Signal("GPU", "max", ["/gpu-nvidia/0, Core #0", "/gpu-nvidia/0, Core #1"]),
+        "Drives": Signal("Drives", "avg", ["/hdd/0, *", "/hdd/1", "/nvme/0, Core #3"]),
+        "Board": Signal("Board", "avg", ["/lpc/nct6798d, Core #{0}".format(n) for n in range(0, 8)]),
+    }
+    number = 2000
+    print("signal evaluation of {0} signals over {1} sensors, {2} samples:".format(len(signals), len(catalog), number))
+    sensors = [LegacySensor(parent, name, 40 + random.random()) for parent, name in catalog]
+
+    def scan(fn, selectors):
+        # signal evaluation before selectors were compiled
+        count = 0
+        max = 0
+        avg = 0
+        for s in selectors:
+            parts = [x.strip() for x in s.split (",")]
+            parts.append("")
+            devicename = parts[0]
+            sensorname = parts[1]
+            if sensorname == "*": sensorname = ""
+            for _s in sensors:
+                if _s.parent == devicename and ( sensorname == "" or _s.name == sensorname):
+                    val = _s.value
+                    if (val > max): max = val
+                    avg += val
+                    count += 1
+        res = max
+        if (fn == "avg" and count > 0): res = avg / float(count)
+        return res
+
+    def scanned():
+        for s in signals.values(): s.update(scan(s.fn, s.sensors))
+
+    source = SensorSource()
+    source.setreadings([(x.parent, x.name, x.value) for x in sensors])
+    snapshot = source.snapshot()
+    scantime = timeit.timeit(scanned, number=number) / number * 1000
+    compiletime = timeit.timeit(lambda: snapshot.updateSignals(signals), number=number) / number * 1000
+    print("  scan: {0:6.3f} ms   compiled: {1:6.3f} ms   speedup: {2:.1f}x".format(scantime, compiletime, scantime / compiletime))
+
+
+def bench_snapshot(args):
+    """Storing a sample of sensor readings: a sorted list of new Sensor objects per sample, as before snapshots,
+       vs. values written into the slots of a stable catalog and copied into a snapshot array"""
+    catalog = sensorcatalog()
+    random.shuffle(catalog)     # the order of a WMI query
+    readings = [(parent, name, 40 + random.random()) for parent, name in catalog]
+    number = 2000
+    print("sensor sample of {0} readings, {1} samples:".format(len(readings), number))
+
+    legacykeys = []
+    def legacy():
+        # Hamon.update() and setsensors() before snapshots
+        sensors = sorted([LegacySensor(parent, name, value) for parent, name, value in readings], key = lambda x: (x.parent, x.name))
+        keys = [(x.parent, x.name) for x in sensors]
+        if (keys != legacykeys): legacykeys[:] = keys
+        devicenames = set([x.parent for x in sensors])
+        return sensors, devicenames
+
+    source = SensorSource()
+    def compact():
+        source.setreadings(readings)
+        return source.snapshot()
+
+    legacytime = timeit.timeit(legacy, number=number) / number * 1000
+    compacttime = timeit.timeit(compact, number=number) / number * 1000
+    print("  Sensor objects: {0:6.3f} ms   catalog and array: {1:6.3f} ms   speedup: {2:.1f}x".format(
+        legacytime, compacttime, legacytime / compacttime))
+
+    # keep the samples alive like the UI does with the last one, to count what they hold on to
+    kept = []
+    legacyblocks = allocations(lambda: kept.append(legacy()), 100)
+    kept = []
+    compactblocks = allocations(lambda: kept.append(compact()), 100)
+    print("  memory blocks per sample: {0:.0f} vs. {1:.0f}".format(legacyblocks, compactblocks))
+
+
+def bench_poll(args):
+    """Round trip per command vs. pipelined telemetry poll"""
+    grid = emulatedgrid(args)
+    print("Telemetry poll of {0} fans at {1} baud, {2}, {3} rounds:".format(
+        NZXTGrid.NUM_FANS, grid.com.baudrate, latencytext(args), args.rounds))
+
+    cases = [
+        ("rpm+voltage", dict(pollrpm=True, pollvoltage=True, pollamperage=False)),
+        ("rpm+voltage+amperage", dict(pollrpm=True, pollvoltage=True, pollamperage=True)),
+    ]
+    for name, kwargs in cases:
+        expected = grid.poll(**kwargs)
+        if grid.poll(pipelined=True, **kwargs) != expected:
+            print("  {0}: pipelined poll returned different data".format(name))
+        roundtrip = measure(lambda: grid.poll(**kwargs), args.rounds)
+        pipelined = measure(lambda: grid.poll(pipelined=True, **kwargs), args.rounds)
+        print("  {0:22} round trip: {1:6.1f} ms   pipelined: {2:6.1f} ms   speedup: {3:.2f}x".format(
+            name, roundtrip[1], pipelined[1], roundtrip[1] / pipelined[1]))
+    if (not grid.ok): print(grid.errorMessage)
+    closegrid(grid)
+
+
+def bench_write(args):
+    """One setfanspeed() per fan vs. a single set_fan_speeds() for all fans"""
+    grid = emulatedgrid(args)
+    print("Speed update of {0} fans at {1} baud, {2}, {3} rounds:".format(
+        NZXTGrid.NUM_FANS, grid.com.baudrate, latencytext(args), args.rounds))
+    fanids = range(1, NZXTGrid.NUM_FANS+1)
+    speeds = [60, 100]   # alternate so that every round changes the voltage of every fan
+
+    def sequential():
+        speeds.reverse()
+        for fanid in fanids: grid.setfanspeed(fanid, speeds[0])
+
+    def bulk():
+        speeds.reverse()
+        grid.set_fan_speeds(dict([(fanid, speeds[0]) for fanid in fanids]))
+
+    onebyone = measure(sequential, args.rounds)
+    batched = measure(bulk, args.rounds)
+    print("  one by one: {0:6.1f} ms   batched: {1:6.1f} ms   speedup: {2:.2f}x".format(
+        onebyone[1], batched[1], onebyone[1] / batched[1]))
+    if (not grid.ok): print(grid.errorMessage)
+    closegrid(grid)
+
+
+def bench_priority(args):
+    """Latency of a fan speed update issued right after a telemetry poll of all fans has been queued:
+       one poll job for all fans vs. one low priority job per fan"""
+    grid = emulatedgrid(args)
+    worker = GridWorker(grid)
+    worker.start()
+    fanids = list(range(1, NZXTGrid.NUM_FANS+1))
+    speeds = [60, 100]
+    print("Speed update latency behind a telemetry poll, {0}, {1} rounds:".format(latencytext(args), args.rounds))
+
+    def writebehind(split):
+        if (split):
+            polls = [worker.submit(TELEMETRY, grid.polltelemetry, [fanid]) for fanid in fanids]
+        else:
+            polls = [worker.submit(TELEMETRY, grid.polltelemetry, fanids)]
+        time.sleep(0.001)    # let the worker pick up the first poll job
+        speeds.reverse()
+        t = time.perf_counter()
+        worker.submit(WRITE, grid.set_fan_speeds, {1: speeds[0]}).result()
+        latency = (time.perf_counter() - t) * 1000
+        for p in polls: p.result()
+        return latency
+
+    single = [writebehind(False) for i in range(0, args.rounds)]
+    split = [writebehind(True) for i in range(0, args.rounds)]
+    print("  behind one poll job: {0:6.1f} ms   behind per-fan poll jobs: {1:6.1f} ms".format(
+        sum(single) / len(single), sum(split) / len(split)))
+    worker.stop()
+    closegrid(grid)
+
+
+def bench_soak(args):
+    """Runs controller-like cycles (a few speed writes + telemetry poll) for a while, recovering from errors
+       the same way the controller does. Use --droprate/--strayrate to inject faults."""
+    grid = emulatedgrid(args)
+    rnd = random.Random(args.seed)
+    print("Soak test for {0} sec, droprate {1}, strayrate {2}:".format(args.duration, args.droprate, args.strayrate))
+    cycles = 0
+    reconnects = 0
+    times = []
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        t = time.perf_counter()
+        if (not grid.ok):
+            reconnects += 1
+            port = grid.port
+            grid.close()
+            grid.open(port)
+            if grid.ok: grid.hello()
+        if (grid.ok):
+            speeds = {}
+            for i in range(0, rnd.randrange(0, 3)):
+                speeds[rnd.randrange(1, NZXTGrid.NUM_FANS+1)] = rnd.randrange(0, 101)
+            grid.set_fan_speeds(speeds)
+        if (grid.ok):
+            grid.poll(pollrpm=True, pollvoltage=True, pollamperage=False, pipelined=args.pipelined)
+        times.append((time.perf_counter() - t) * 1000)
+        cycles += 1
+    times.sort()
+    print("  cycles: {0}, reconnects: {1}, reads: {2}, writes: {3}, errors: {4}, resyncs: {5}, discarded bytes: {6}".format(
+        cycles, reconnects, grid.readCount, grid.writeCount, grid.errorCount, grid.resyncCount, grid.discardCount))
+    print("  " + grid.stats.dump().replace("\n", "\n  "))
+    print("  cycle time, ms: median {0:.1f}, 99th percentile {1:.1f}, max {2:.1f}".format(
+        times[len(times)//2], times[int(len(times)*0.99)], times[-1]))
+    closegrid(grid)
+
+
+BENCHMARKS = {
+    "aggregator": bench_aggregator,
+    "acquisition": bench_acquisition,
+    "codec": bench_codec,
+    "discover": bench_discover,
+    "hotplug": bench_hotplug,
+    "http": bench_http,
+    "hwmon": bench_hwmon,
+    "poll": bench_poll,
+    "priority": bench_priority,
+    "process": bench_process,
+    "signals": bench_signals,
+    "snapshot": bench_snapshot,
+    "soak": bench_soak,
+    "write": bench_write,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PyGrid benchmarks against an emulated Grid")
+    parser.add_argument("benchmarks", nargs="*", help="any of: " + ", ".join(sorted(BENCHMARKS.keys())))
+    parser.add_argument("--latency", type=float, default=2.0, help="device latency per command, msec")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--pty", action="store_true", help="serve the emulated Grid on a pseudo-terminal (POSIX only)")
+    parser.add_argument("--duration", type=float, default=10.0, help="soak test duration, sec")
+    parser.add_argument("--droprate", type=float, default=0.0, help="probability of a missing response")
+    parser.add_argument("--strayrate", type=float, default=0.0, help="probability of a garbage byte before a response")
+    parser.add_argument("--pipelined", action="store_true", help="use pipelined polls in the soak test")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--trace", default=None, help="take the device latency from a captured trace (see gridtrace.py)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if not name in BENCHMARKS: parser.error("unknown benchmark '{0}'".format(name))
+    for name in (args.benchmarks or sorted(BENCHMARKS.keys())):
+        BENCHMARKS[name](args)
+        print()
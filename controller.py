@@ -6,13 +6,21 @@ from collections import OrderedDict
 import PyQt5.QtCore as QtCore
 from PyQt5.QtCore import QThread, pyqtSignal, pyqtSlot, QEvent
 
-from hardware import NZXTGrid, Hamon, Signal
-from settings import AppSettings
-from util import timediff
+from hardware import NZXTGrid
+from sensors import Signal
+from acquisition import SensorAcquisition
+from sensorprocess import SensorProcess
+from settings import AppSettings, gridports, gridcaptures
+from gridio import GridWorker, results, HANDSHAKE, WRITE, TELEMETRY
+from util import timediff, ReconnectPolicy
+from hotplug import HotplugWatcher
+from gridmux import GridMux
+from discovery import relocate, remember
 
 
 class Controller(QThread):
-    """Polls data from Libre Hardware Monitor and Grid, applies control policy to fans, emits update signal to UI."""
+    """Takes sensor readings from Libre Hardware Monitor (via SensorAcquisition) and polls data from Grid,
+       applies control policy to fans, emits update signal to UI."""
     ok = True
     errorMessage = ""
     appsettings = None
@@ -26,15 +34,30 @@ class Controller(QThread):
 
     uiUpdate = pyqtSignal(dict, name="uiUpdateSignal")
     enableUICallbacks = False
-
-    grid = None
-    hamon = None
+    showsensors = False     # the UI lists all sensors, which are then read even if no signal needs them
+
+    grids = []          # one NZXTGrid per port in settings
+    workers = []        # one GridWorker per Grid, all port I/O of a Grid happens on its worker thread
+    gridpolicies = []   # one ReconnectPolicy per Grid
+    numfans = 0         # total nr of fans on all Grids
+    acquisition = None  # SensorAcquisition or SensorProcess reading the sensor source selected in settings, e.g. Libre Hardware Monitor
+    snapshot = None     # SensorSnapshot the current cycle runs on
+    telemetrypoller = None
+    hotplug = None
+    mux = None          # GridMux serving telemetry to other programs, if enabled in settings
     shutdown = False    # shutdown is requested by the UI thread
 
+    POLL_BUDGET = 150   # default time allowed for fan telemetry polls per cycle, msec
+    MAX_SENSOR_AGE = 5  # sensor readings older than that many seconds are not used for control
+    FIRST_SAMPLE_TIMEOUT = 2.0      # how long the first cycle waits for sensor readings, seconds
+
 
     def __init__(self, appsettings):
         QThread.__init__(self)
         self.appsettings = appsettings
+        self.gridslock = threading.Lock()   # guards the list of Grids against the telemetry poller while it changes
+        self.queuedpolls = {}               # (grid index, fanid) -> (Future, polls amperage), see requesttelemetry()
+        self.wakeup = threading.Event()     # set by kick() to run the next cycle right away
 
 
     def _err(self, errtext):
@@ -47,8 +70,13 @@ class Controller(QThread):
 
     def run(self):
         """threadproc"""
-        self.hamon = Hamon()
-        self.grid = NZXTGrid()
+        settings = self.appsettings.settings
+        self.startacquisition(settings)
+        self.acquisition.published.wait(self.FIRST_SAMPLE_TIMEOUT)
+        self.telemetrypoller = TelemetryPoller(self)
+        self.telemetrypoller.start()
+        self.hotplug = HotplugWatcher(self.hotplugged)
+        self.hotplug.start()
         print ("Controller has started")
 
         TIME_SLICE = 1000         # sampling period, msec
@@ -57,18 +85,19 @@ class Controller(QThread):
         td = timediff()
         while not self.shutdown:
             td.reset()
+            self.wakeup.clear()
             self.dowork()   # do all controller stuff, once per time slice
             td.now()
             exec_time = td.ms
             remaining = TIME_SLICE
             sleep_count = 0
             while remaining > 0:
-                if self.shutdown or self.settingsTS < self.appsettings.timestamp: break    # early exit if needed
+                if self.shutdown or self.settingsTS < self.appsettings.timestamp or self.wakeup.is_set(): break    # early exit if needed
                 td.now()
                 remaining = TIME_SLICE - td.ms
                 if (remaining > MAX_SLEEP): remaining = MAX_SLEEP
                 if (remaining > 0):
-                    time.sleep(remaining / 1000.0)
+                    self.wakeup.wait(remaining / 1000.0)
                     sleep_count += 1
 
             td.now()
@@ -76,22 +105,135 @@ class Controller(QThread):
             #print ("loop={0}, exec={1}, slice={2}, sleep count={3}".format(counter, exec_time, slice_time, sleep_count))
             counter += 1
 
-        self.grid.close()
-        self.hamon.close()
+        self.telemetrypoller.stop()
+        self.hotplug.stop()
+        self.startmux(None)
+        self.creategrids(0)
+        self.acquisition.stop()
         print ("Controller has stopped")
 
 
     def stop(self):
         self.shutdown = True
+        self.wakeup.set()
         self.wait()
 
 
+    def kick(self):
+        """Retries the devices that are offline right away instead of waiting for their backoff to expire,
+           e.g. when a device has been plugged in. Can be called from any thread"""
+        for policy in self.gridpolicies:
+            policy.kick()
+        self.acquisition.kick()
+        self.wakeup.set()
+
+
+    def startacquisition(self, settings):
+        """Starts reading sensors, in a worker process if the sensors settings say "process": true"""
+        config = settings.get("sensors", {})
+        acquisition = SensorProcess if config.get("process", False) else SensorAcquisition
+        if (type(self.acquisition) is acquisition):
+            self.acquisition.configure(config)
+            return
+        if (self.acquisition): self.acquisition.stop()
+        self.acquisition = acquisition(config, self.sensorselectors(settings))
+        self.acquisition.start()
+
+
+    def sensorselectors(self, settings):
+        """Returns the sensor selectors of all signals in settings, each one once"""
+        res = []
+        for s in settings["signals"].values():
+            for selector in s["sensors"]:
+                if (not selector in res): res.append(selector)
+        return res
+
+
+    def hotplugged(self, port, present):
+        """Called by the hotplug watcher when the device of a Grid port appears or disappears"""
+        if (not present):
+            with self.gridslock:
+                for grid, worker in zip(self.grids, self.workers):
+                    if (grid.port == port): worker.submit(HANDSHAKE, grid.detach)
+        self.kick()
+
+
+    def creategrids(self, count):
+        """(Re)creates Grid objects along with their I/O workers if the number of Grids has changed"""
+        if (count == len(self.grids)): return
+        with self.gridslock:
+            for i in range(0, len(self.grids)):
+                self.workers[i].submit(HANDSHAKE, self.grids[i].capture, None)
+                self.workers[i].submit(HANDSHAKE, self.grids[i].close)
+                self.workers[i].stop()
+            self.grids = [NZXTGrid() for i in range(0, count)]
+            self.workers = [GridWorker(self.grids[i], name="GridWorker{}".format(i+1)) for i in range(0, count)]
+            self.gridpolicies = [ReconnectPolicy() for i in range(0, count)]
+            self.queuedpolls = {}
+            for w in self.workers: w.start()
+            self.numfans = NZXTGrid.NUM_FANS * count
+
+
+    def startmux(self, port):
+        """(Re)starts the Grid multiplexer if its port has changed, None stops it"""
+        if (self.mux and self.mux.port == port): return
+        if (self.mux): self.mux.stop()
+        self.mux = None
+        if (port):
+            self.mux = GridMux(self, port)
+            if (not self.mux.start()): self.mux = None
+
+
+    def requesttelemetry(self, i, fanid, pollamperage=False):
+        """Queues a telemetry poll of a fan of Grid i, returns its Future. If a poll of that fan is already queued
+           (by the telemetry poller or a multiplexer client) and covers the same readings, that one is returned instead,
+           so concurrent requests cause a single poll. The caller holds gridslock"""
+        queued = self.queuedpolls.get((i, fanid))
+        if (queued and not queued[0].done() and (queued[1] or not pollamperage)):
+            return queued[0]
+        future = self.workers[i].submit(TELEMETRY, self.grids[i].polltelemetry, [fanid],
+            pollrpm=True, pollvoltage=True, pollamperage=pollamperage)
+        self.queuedpolls[(i, fanid)] = (future, pollamperage)
+        return future
+
+
+    def requestpipelined(self, i, fanids):
+        """Queues a single pipelined poll of RPM and voltage of the fans of Grid i, leaving out the fans whose poll
+           is already queued. Returns the Futures of all polls the fans wait for. The caller holds gridslock"""
+        futures = []
+        polled = []
+        for fanid in fanids:
+            queued = self.queuedpolls.get((i, fanid))
+            if (queued and not queued[0].done()):
+                if (not queued[0] in futures): futures.append(queued[0])
+            else:
+                polled.append(fanid)
+        if (len(polled) > 0):
+            future = self.workers[i].submit(TELEMETRY, self.grids[i].polltelemetry, polled,
+                pollrpm=True, pollvoltage=True, pollamperage=False, pipelined=True)
+            for fanid in polled: self.queuedpolls[(i, fanid)] = (future, False)
+            futures.append(future)
+        return futures
+
+
+    def reconnect(self, grid, port):
+        """Reopens a Grid, runs on the Grid's worker thread.
+           Returns the list of fanids whose voltage is not what the controller has set before"""
+        grid.close()
+        grid.open(port)
+        if grid.ok: grid.hello()
+        if grid.ok: return grid.verifyspeeds()
+        return []
+
+
+    def gridsok(self):
+        return len(self.grids) > 0 and all([g.ok for g in self.grids])
+
+
     def dowork(self):
         """Fan controller logic"""
         self.ok = True   # reset prior errors
 
-        NFANS = NZXTGrid.NUM_FANS
-
         # in terms of race conditions we can only clash with the UI on settings update, so we need a lock:
         with self.appsettings.lock:
             settings = self.appsettings.settings
@@ -99,14 +241,43 @@ class Controller(QThread):
             # check if settings have been changed based on timestamps
             reset = self.settingsTS < self.appsettings.timestamp
 
-            # if grid is not responding, retry opening port. This also allows to unplug the grid and plug it back at any time
-            reset = reset or not self.grid.ok
+            # if grid is not responding, retry opening port. This also allows to unplug the grid and plug it back at any time.
+            # Reconnecting is a hardware matter: filters and fan speed caches survive it, only the fans whose
+            # voltage Grid does not confirm after the reconnect are written again.
+            # Retries back off exponentially, so a Grid that has been removed costs next to nothing
+            ports = gridports(settings)
+            lost = []
+            if (not reset and not self.gridsok()):
+                # a Grid whose device is missing is not retried at all, the hotplug watcher kicks us once it is back
+                failed = [i for i in range(0, len(self.grids))
+                          if not self.grids[i].ok and self.hotplug.present(ports[i]) and self.gridpolicies[i].ready()]
+                for i in failed: self.grids[i].quiet = self.gridpolicies[i].failures > 0   # report the first failure only
+                stale = results([self.workers[i].submit(HANDSHAKE, self.reconnect, self.grids[i], ports[i]) for i in failed])
+                for i, fanids in zip(failed, stale):
+                    self.gridpolicies[i].result(self.grids[i].ok)
+                    if (self.grids[i].ok): remember(ports[i], self.appsettings.portcache())
+                    for fanid in fanids: self.current_fan_speed[i*NZXTGrid.NUM_FANS + fanid] = -1
+
+                # a Grid whose port has gone away may have got another port (e.g. a new COM number), see below
+                lost = [i for i in range(0, len(self.grids)) if not self.grids[i].ok and
+                        not self.hotplug.present(ports[i]) and self.gridpolicies[i].ready()]
+
             if (reset):
                 #print("Resetting controller...")
-                port = settings["grid"]["port"]
-                self.grid.close()
-                self.grid.open(port)
-                if self.grid.ok: self.grid.hello()
+                # all Grids are reopened in parallel, each one on its own worker thread
+                self.creategrids(len(ports))
+                self.hotplug.watch(ports)
+                self.startmux(settings["grid"].get("muxport"))
+                captures = gridcaptures(settings)
+                results([self.workers[i].submit(HANDSHAKE, self.grids[i].capture, captures[i]) for i in range(0, len(ports))])
+                results([self.workers[i].submit(HANDSHAKE, self.reconnect, self.grids[i], ports[i]) for i in range(0, len(ports))])
+                for i in range(0, len(ports)):
+                    self.grids[i].quiet = False
+                    self.gridpolicies[i].result(self.grids[i].ok)
+                    if (self.grids[i].ok): remember(ports[i], self.appsettings.portcache())
+                self.startacquisition(settings)
+                self.acquisition.kick()      # settings may have fixed whatever was wrong
+                NFANS = self.numfans
 
                 # create fan speed caches
                 self.current_fan_speed = [-1] * (NFANS+1)   # reset caches
@@ -131,32 +302,91 @@ class Controller(QThread):
                 # save the timestamp of newest settings to track further changes
                 self.settingsTS = self.appsettings.timestamp
 
-            # get recent readings from Libre Hardware Monitor and apply control policy
-            self.hamon.update()
-            if self.hamon.ok:
-                self.hamon.updateSignals(self.signals)
-
-            if (self.hamon.ok and self.grid.ok):
-                self.control()
+            # only the sensors the signals need are read, unless the UI shows all of them
+            self.acquisition.demand(None if self.enableUICallbacks and self.showsensors else self.sensorselectors(settings))
+
+            # get recent sensor readings and apply control policy. Sensors are read on their own thread,
+            # the cycle takes the latest complete snapshot without waiting for the source
+            self.snapshot = self.acquisition.latest
+            if (self.snapshot.ok):
+                age = self.snapshot.age()
+                if (age > self.MAX_SENSOR_AGE):
+                    self._err("No sensor readings from {0} for {1:.0f} seconds.".format(self.snapshot.name, age))
+                elif (not self.snapshot.updateSignals(self.signals)):
+                    # if no readings were found assume the source is not (yet) running
+                    self._err("The data from {0} is unavailable.\nPlease check if it is running.".format(self.snapshot.name))
+                else:
+                    self.control()
 
         # pack data into a dict for visualization, emit signal to UI
+        # fan telemetry comes from the cache filled by the telemetry poller, the control loop never waits for it
         #self.enableUICallbacks = True
         if self.enableUICallbacks:
             fans = []
-            if (self.grid.ok): fans = self.grid.poll(pollrpm=True, pollvoltage=True, pollamperage=False)
+            fanage = []
+            for grid in self.grids:
+                fans.extend(grid.telemetry.fandata())
+                fanage.extend([grid.telemetry.age(f, "rpm") for f in range(1, NZXTGrid.NUM_FANS+1)])
             signalData = {
-                "sensors": self.hamon.sensors, "signals": self.signals,
-                "fans": fans, "fanspeed": self.current_fan_speed[1:NFANS+1]
+                "sensors": self.snapshot, "signals": self.signals,
+                "fans": fans, "fanspeed": self.current_fan_speed[1:self.numfans+1],
+                "fanage": fanage
             }
             self.uiUpdate.emit(signalData)
 
+        if (lost): self.relocategrids(lost, ports)
+
+
+    def relocategrids(self, lost, ports):
+        """Looks up the Grids whose port has gone away among the current ports, by the USB device the port cache
+           remembers for them. Runs without the settings lock at the pace of the backoff of each Grid; once found
+           the settings are saved with the new port, which resets the controller on the next cycle"""
+        for i in lost:
+            port = relocate(ports[i], self.appsettings.portcache(), exclude=ports)
+            if (port is None):
+                self.gridpolicies[i].result(False)
+                continue
+            with self.appsettings.lock:
+                if (gridports(self.appsettings.settings) != ports): return    # the settings have changed meanwhile
+                print ("NZXT Grid has moved from {0} to {1}".format(ports[i], port))
+                self.appsettings.relocate(i, port)
+                ports = gridports(self.appsettings.settings)
+
+
+    def pollfans(self, settings):
+        """Polls fan telemetry of all Grids in parallel into their telemetry caches within the serial time budget
+           of a single cycle. Hidden fans (empty name) and fans that are off are not polled.
+           Every fan is polled by a separate low priority job, so speed updates can get in between. With "pipelined"
+           the fans of a Grid are polled by a single job in one write instead, which is faster but keeps a speed update
+           waiting until all of them have answered."""
+        gridsettings = settings["grid"]
+        budget = gridsettings.get("pollbudget", self.POLL_BUDGET) / 1000.0
+        pipelined = gridsettings.get("pipelined", False)
+        with self.gridslock:
+            futures = []
+            for i in range(0, len(self.grids)):
+                if (not self.grids[i].ok): continue
+                fanids = []
+                for fanid in range(1, NZXTGrid.NUM_FANS+1):
+                    # settings may already list fewer Grids than we have until the next control cycle catches up
+                    policy = settings["policy"].get("fan{}".format(i*NZXTGrid.NUM_FANS + fanid))
+                    if (policy and policy["name"] != "" and not policy["mode"] in ["off", ""]):
+                        fanids.append(fanid)
+                fanids = self.grids[i].scheduler.select(fanids, budget)
+                if (pipelined):
+                    futures.extend(self.requestpipelined(i, fanids))
+                else:
+                    for fanid in fanids: futures.append(self.requesttelemetry(i, fanid))
+        # waits without the lock, so that multiplexer clients can share the queued polls meanwhile
+        results(futures)
+
 
     def control(self):
         """Loops through all fans, applies control policy to each, sends updates to Grid"""
         settings = self.appsettings.settings
 
         # for each fan, apply control policy to determine the new fan speed
-        for f in range(1, NZXTGrid.NUM_FANS+1):
+        for f in range(1, self.numfans+1):
             policy = settings["policy"]["fan{}".format(f)]
             self.new_fan_speed[f] = self.control_fan(f, policy)
 
@@ -164,15 +394,27 @@ class Controller(QThread):
         # this means almost 100% of the time there is no traffic on the COM port
         writethrough = False
         writethrough = self.appsettings.gridstats    # true for debugging
-        for f in range(1, NZXTGrid.NUM_FANS+1):
-            speed = self.new_fan_speed[f]
-            if (self.current_fan_speed[f] != speed or writethrough):
-                self.grid.setfanspeed(f, speed)
-                # for some reason occasionally (once in ~10000 commands) grid will fail to respond and produce an error
-                # we will try to reestablish communication with the controller and will update RPMs during the next cycle
-                if (not self.grid.ok): break
+        futures = {}
+        for i in range(0, len(self.grids)):
+            if (not self.grids[i].ok): continue    # will be reconnected during the next cycle
+            speeds = OrderedDict()
+            for fanid in range(1, NZXTGrid.NUM_FANS+1):
+                f = i*NZXTGrid.NUM_FANS + fanid
+                speed = self.new_fan_speed[f]
+                if (self.current_fan_speed[f] != speed or writethrough):
+                    speeds[fanid] = speed
+            # all changed fans of a Grid are updated in one go, all Grids are updated in parallel
+            if (len(speeds) > 0):
+                futures[i] = self.workers[i].submit(WRITE, self.grids[i].set_fan_speeds, speeds, force=writethrough)
+
+        # For some reason occasionally (once in ~10000 commands) grid will fail to respond to a command -
+        # we will try to reestablish communication with the controller and will retry the fans that failed during the next cycle
+        for i in futures.keys():
+            res = futures[i].result()
+            for fanid in res.keys():
                 # update the cache only if fan speed update was successful
-                self.current_fan_speed[f] = speed
+                f = i*NZXTGrid.NUM_FANS + fanid
+                if (res[fanid]): self.current_fan_speed[f] = self.new_fan_speed[f]
 
 
     def control_fan(self, fanindex, policy):
@@ -195,7 +437,8 @@ class Controller(QThread):
             temp = 100   # if no matching singnal is found, assume the system is rather hot than cold.
             if (signal_name in self.signals):
                 signal = self.signals[signal_name]
-                temp = signal.value
+                # a signal whose sensors have no current readings (e.g. a sensor backend has failed) counts as hot
+                temp = signal.value if signal.available else 100
             elif (signal_name == ""):
                 temp = 0
             else:
@@ -234,6 +477,30 @@ class Controller(QThread):
 
 
 
+class TelemetryPoller(threading.Thread):
+    """Polls fan telemetry at its own pace, independently of the control cycle.
+       Runs only while somebody is looking (UI callbacks are enabled), readings go to grid.telemetry."""
+
+    PERIOD = 1.0    # seconds
+
+    def __init__(self, controller):
+        threading.Thread.__init__(self, name="TelemetryPoller", daemon=True)
+        self.controller = controller
+        self.shutdown = threading.Event()
+
+    def run(self):
+        """threadproc"""
+        c = self.controller
+        while not self.shutdown.wait(self.PERIOD):
+            if (c.enableUICallbacks and c.appsettings.ok):
+                c.pollfans(c.appsettings.settings)
+
+    def stop(self):
+        self.shutdown.set()
+        self.join()
+
+
+
 class MovingAverage():
     """Moving Average filter"""
 
@@ -0,0 +1,99 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from hardware import list_comports, NZXTGrid
+
+
+PROBE_TIMEOUT = 0.05    # the Grid answers the handshake within a few msec, seconds
+PORT_CACHE = "pygrid-ports.json"    # in the folder of the app
+
+
+def deviceid(portinfo):
+    """Returns "VID:PID:serial" of a USB serial port, None for other ports (nothing to recognize them by)"""
+    vid = getattr(portinfo, "vid", None)
+    pid = getattr(portinfo, "pid", None)
+    if (vid is None or pid is None): return None
+    return "{0:04X}:{1:04X}:{2}".format(vid, pid, getattr(portinfo, "serial_number", None) or "")
+
+
+def probe(port, timeout=PROBE_TIMEOUT):
+    """Returns True if a Grid answers the handshake on a given port"""
+    grid = NZXTGrid()
+    grid.quiet = True
+    grid.open(port, timeout)
+    if grid.ok: grid.hello()
+    grid.close()
+    return grid.ok
+
+
+def probeall(ports, timeout=PROBE_TIMEOUT):
+    """Probes all ports at the same time, returns the ones a Grid answers on, in the given order"""
+    if (len(ports) == 0): return []
+    with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        answers = list(executor.map(lambda port: probe(port, timeout), ports))
+    return [port for port, ok in zip(ports, answers) if ok]
+
+
+
+class PortCache():
+    """Remembers the USB serial devices Grids have been found on (by VID:PID:serial number),
+       so that the Grid can be found again without probing even if Windows assigns it another COM port"""
+
+    def __init__(self, path):
+        self.path = path
+        self.devices = {}    # device id -> port the Grid answered on last time
+        try:
+            with open(self.path, "r") as f:
+                self.devices = json.load(f)
+        except Exception:
+            pass    # no cache yet, or the file is damaged: probe again
+
+    def save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.devices, f, indent=2)
+        except Exception as e:
+            print ("Failed to save {0}. {1}".format(self.path, str(e)))
+
+
+
+def discover(cachepath=None, timeout=PROBE_TIMEOUT):
+    """Returns the list of ports with a Grid attached. Ports of devices known from the cache are taken
+       without probing, otherwise all ports are probed in parallel and the cache is updated"""
+    portinfos = list_comports()
+    cache = PortCache(cachepath) if cachepath else None
+    if (cache):
+        known = [p.device for p in portinfos if deviceid(p) in cache.devices]
+        if (len(known) > 0): return known
+
+    found = probeall([p.device for p in portinfos], timeout)
+    if (cache and len(found) > 0):
+        for p in portinfos:
+            if (p.device in found and deviceid(p)): cache.devices[deviceid(p)] = p.device
+        cache.save()
+    return found
+
+
+def remember(port, cachepath):
+    """Records the USB device of a port a Grid has answered on, so that relocate() finds it on another port"""
+    ids = [deviceid(p) for p in list_comports() if p.device == port]
+    if (len(ids) == 0 or ids[0] is None): return
+    cache = PortCache(cachepath)
+    if (cache.devices.get(ids[0]) == port): return
+    cache.devices[ids[0]] = port
+    cache.save()
+
+
+def relocate(port, cachepath, exclude=[]):
+    """Returns the port a Grid that was on a given port is attached to now (e.g. Windows has assigned it another
+       COM port), None if it is not found. Only the USB device the cache remembers for the port is looked up,
+       nothing is probed, so this is cheap enough to be retried. Ports in exclude (those of other Grids) are left alone"""
+    portinfos = [p for p in list_comports() if p.device != port and not p.device in exclude]
+    cache = PortCache(cachepath)
+    ids = [id for id, device in cache.devices.items() if device == port]
+    for p in portinfos:
+        if (deviceid(p) in ids):
+            cache.devices[deviceid(p)] = p.device
+            cache.save()
+            return p.device
+    return None
@@ -0,0 +1,284 @@
+import os
+import time
+import random
+import select
+import argparse
+import threading
+
+
+class GridModel():
+    """Emulates command processing of NZXT Grid+ V2 (see NZXTGrid for the command set)"""
+
+    NUM_FANS = 6
+    MAX_RPM = 1800        # RPM of an emulated fan at 12 V
+    MAX_AMPERAGE = 0.30   # current drawn by an emulated fan at 12 V
+
+    # total command length by the first byte of the command
+    COMMAND_LENGTH = {0xC0: 1, 0x44: 7, 0x84: 2, 0x85: 2, 0x8A: 2}
+
+    def __init__(self):
+        self.voltage = [12.0] * (self.NUM_FANS+1)   # Grid starts all fans at full speed
+        self.pending = bytearray()                  # incomplete command received so far
+
+    def feed(self, data):
+        """Consumes incoming bytes, returns a list of (command, response) pairs for every completed command.
+           Unknown bytes are skipped the same way the device ignores them."""
+        self.pending.extend(data)
+        res = []
+        while len(self.pending) > 0:
+            code = self.pending[0]
+            length = self.COMMAND_LENGTH.get(code, 0)
+            if (length == 0):
+                del self.pending[0]
+                continue
+            if (len(self.pending) < length):
+                break
+            command = bytes(self.pending[:length])
+            del self.pending[:length]
+            res.append((command, self.execute(command)))
+        return res
+
+    def execute(self, command):
+        """Returns response bytes for a single complete command"""
+        code = command[0]
+        if (code == 0xC0):
+            return b"\x21"
+
+        fanid = command[1]
+        if (fanid < 1 or fanid > self.NUM_FANS):
+            return b"\x02"   # the real device does not document this case
+
+        if (code == 0x44):
+            self.voltage[fanid] = command[5] + command[6] / 100.0
+            return b"\x01"
+
+        voltage = self.voltage[fanid]
+        if (code == 0x8A):
+            rpm = 0
+            if (voltage >= 4): rpm = int(voltage / 12.0 * self.MAX_RPM)   # fans stall below ~40%
+            return bytes([0xC0, 0x00, 0x00, rpm // 256, rpm % 256])
+        if (code == 0x84):
+            value = voltage
+        else:
+            value = voltage / 12.0 * self.MAX_AMPERAGE
+        hundredths = int(round(value * 100))
+        return bytes([0xC0, 0x00, 0x00, hundredths // 100, hundredths % 100])
+
+
+
+class GridLink():
+    """Timing and fault injection shared by all emulated Grid transports.
+       latency:   time between receiving the last byte of a command and starting to answer, in seconds.
+                  Either a number or a dict of {command code: seconds}, e.g. {0x44: 0.02}
+       droprate:  probability that the device does not answer a command at all
+       strayrate: probability that a garbage byte is sent ahead of a response"""
+
+    def __init__(self, model=None, latency=0.002, droprate=0.0, strayrate=0.0, seed=None):
+        self.model = model if model else GridModel()
+        self.latency = latency
+        self.droprate = droprate
+        self.strayrate = strayrate
+        self.random = random.Random(seed)
+        self.dropCount = 0
+        self.strayCount = 0
+
+    def commandlatency(self, command):
+        if isinstance(self.latency, dict):
+            return self.latency.get(command[0], 0.0)
+        return self.latency
+
+    def inject(self, response):
+        """Applies fault injection to a response about to be sent back"""
+        if (self.droprate > 0 and self.random.random() < self.droprate):
+            self.dropCount += 1
+            return b""
+        if (self.strayrate > 0 and self.random.random() < self.strayrate):
+            self.strayCount += 1
+            return bytes([self.random.randrange(0, 256)]) + response
+        return response
+
+
+
+class EmulatedSerial(GridLink):
+    """Drop-in replacement for serial.Serial that talks to an emulated Grid in-process.
+       Models line time at the configured baud rate in both directions and a fixed device latency
+       per command, so it can be assigned to NZXTGrid.com to benchmark the protocol without hardware."""
+
+    def __init__(self, model=None, latency=0.002, droprate=0.0, strayrate=0.0, seed=None):
+        GridLink.__init__(self, model, latency, droprate, strayrate, seed)
+        self.port = ""
+        self.baudrate = 4800
+        self.bytesize = 8
+        self.parity = "N"
+        self.stopbits = 1
+        self.timeout = 0.1
+        self.write_timeout = 0.1
+        self.is_open = False
+        self.rxqueue = []         # (time when the byte is fully received, byte value)
+        self.rxbusy = 0           # time when the device finishes transmitting everything queued so far
+
+    @property
+    def closed(self):
+        return not self.is_open
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        return len([t for t, _ in self.rxqueue if t <= now])
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        self.rxqueue = []
+
+    def flushInput(self):
+        self.rxqueue = []
+
+    def flushOutput(self):
+        pass
+
+    reset_input_buffer = flushInput
+    reset_output_buffer = flushOutput
+
+    def _bytetime(self):
+        return 10.0 / self.baudrate   # start bit + 8 data bits + stop bit
+
+    def write(self, data):
+        if (not self.is_open):
+            raise IOError("Port is not open")
+        data = bytes(data)
+        bytetime = self._bytetime()
+        start = time.monotonic()
+        consumed = 0
+        # feed byte by byte so that every command is timestamped when its last byte arrives
+        for b in data:
+            consumed += 1
+            for command, response in self.model.feed(bytes([b])):
+                response = self.inject(response)
+                received = start + consumed * bytetime
+                t = max(received + self.commandlatency(command), self.rxbusy)
+                for r in response:
+                    t += bytetime
+                    self.rxqueue.append((t, r))
+                self.rxbusy = t
+        # the call returns once the data has left the transmit buffer
+        _sleepuntil(start + len(data) * bytetime)
+        return len(data)
+
+    def read(self, size=1):
+        if (not self.is_open):
+            raise IOError("Port is not open")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            now = time.monotonic()
+            available = 0
+            while available < len(self.rxqueue) and available < size and self.rxqueue[available][0] <= now:
+                available += 1
+            if (available == size or now >= deadline):
+                break
+            if (available == len(self.rxqueue)):
+                _sleepuntil(deadline)     # nothing else is coming, a real port would wait for the timeout
+            else:
+                _sleepuntil(min(self.rxqueue[available][0], deadline))
+        res = bytes([r for _, r in self.rxqueue[:available]])
+        del self.rxqueue[:available]
+        return res
+
+
+
+class PtyGrid(GridLink):
+    """Emulated Grid served on a pseudo-terminal (POSIX only).
+       After start(), NZXTGrid.open(emulator.port) talks to it like to any other serial port.
+       The host side of the PTY has no notion of baud rate, so the emulator paces its answers itself:
+       a command counts as received 10 bit times per byte after the line was free, and every response
+       byte is released 10 bit times after the previous one."""
+
+    def __init__(self, model=None, baudrate=4800, latency=0.002, droprate=0.0, strayrate=0.0, seed=None):
+        GridLink.__init__(self, model, latency, droprate, strayrate, seed)
+        self.baudrate = baudrate
+        self.port = ""
+        self.master = None
+        self.slave = None
+        self.thread = None
+        self.shutdown = False
+
+    def start(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.shutdown = False
+        self.thread = threading.Thread(target=self.run, name="PtyGrid", daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.shutdown = True
+        if (self.thread): self.thread.join()
+        for fd in (self.master, self.slave):
+            if (fd is not None): os.close(fd)
+        self.master = None
+        self.slave = None
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, ext_type, exc_value, traceback):
+        self.stop()
+
+    def run(self):
+        """threadproc"""
+        bytetime = 10.0 / self.baudrate
+        rxfree = 0    # time when the emulated receive line is free again
+        txfree = 0    # time when the emulated transmit line is free again
+        while not self.shutdown:
+            readable, _, _ = select.select([self.master], [], [], 0.05)
+            if (not readable): continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                continue    # no client attached to the slave side
+            # the line is full duplex: commands keep arriving while earlier responses are being sent
+            received = max(time.monotonic(), rxfree)
+            for b in data:
+                received += bytetime
+                for command, response in self.model.feed(bytes([b])):
+                    response = self.inject(response)
+                    t = max(received + self.commandlatency(command), txfree)
+                    for r in response:
+                        t += bytetime
+                        _sleepuntil(t)
+                        os.write(self.master, bytes([r]))
+                    txfree = t
+            rxfree = received
+
+
+
+def _sleepuntil(t):
+    remaining = t - time.monotonic()
+    if (remaining > 0): time.sleep(remaining)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves an emulated NZXT Grid+ V2 on a pseudo-terminal")
+    parser.add_argument("--baudrate", type=int, default=4800)
+    parser.add_argument("--latency", type=float, default=2.0, help="device latency per command, msec")
+    parser.add_argument("--droprate", type=float, default=0.0, help="probability of a missing response")
+    parser.add_argument("--strayrate", type=float, default=0.0, help="probability of a garbage byte before a response")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    emulator = PtyGrid(baudrate=args.baudrate, latency=args.latency / 1000.0,
+                       droprate=args.droprate, strayrate=args.strayrate, seed=args.seed)
+    print("Emulated Grid is listening at {0}, press Ctrl+C to stop".format(emulator.start()))
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    print("Dropped responses: {0}, stray bytes: {1}".format(emulator.dropCount, emulator.strayCount))
@@ -0,0 +1,53 @@
+import sys
+import queue
+import itertools
+import threading
+from concurrent.futures import Future, wait
+
+
+# Job priorities, lower runs first
+HANDSHAKE = 0     # reopening the port and handshake: nothing else works without it
+WRITE = 1         # fan speed updates
+TELEMETRY = 2     # status polls, keep them small so that writes can get in between
+STOP = sys.maxsize
+
+
+class GridWorker(threading.Thread):
+    """Owns the COM port of one Grid: every command for that Grid is executed on this thread, one job at a time.
+       Jobs wait in a priority queue, so a fan speed update never waits for more than the job currently running.
+       With one worker per Grid, several Grids are driven in parallel."""
+
+    def __init__(self, grid, name="GridWorker"):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.grid = grid
+        self.jobs = queue.PriorityQueue()
+        self.sequence = itertools.count()   # keeps jobs of the same priority in FIFO order
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs) for execution on the worker thread, returns a Future with its result"""
+        future = Future()
+        self.jobs.put((priority, next(self.sequence), future, fn, args, kwargs))
+        return future
+
+    def run(self):
+        """threadproc"""
+        while True:
+            priority, _, future, fn, args, kwargs = self.jobs.get()
+            if (priority == STOP): break
+            if (not future.set_running_or_notify_cancel()): continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    def stop(self):
+        """Finishes the jobs queued so far and stops the thread"""
+        self.jobs.put((STOP, next(self.sequence), None, None, None, None))
+        self.join()
+
+
+
+def results(futures):
+    """Waits for all futures, returns their results in the same order"""
+    wait(futures)
+    return [f.result() for f in futures]
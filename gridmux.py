@@ -0,0 +1,139 @@
+"""Shares the Grids with other local programs while PyGrid owns their COM ports.
+
+   Clients connect to 127.0.0.1:<grid.muxport> and send text lines, every request is answered with one line
+   (FANS: one line per fan followed by END). Fans are numbered as in the settings: fan7 is fan 1 of the second Grid.
+
+     GET <fan> <rpm|voltage|amperage> [MAXAGE]  ->  OK <value> <age, sec>
+         The cached reading is returned if it is not older than MAXAGE seconds (default 2), otherwise the fan is
+         polled; a poll of that fan already queued by PyGrid or another client is shared instead of sending another one.
+     FANS  ->  <fan> <rpm> <voltage> <amperage>  for every fan, from the cache
+     QUIT
+   Errors are answered with ERR <message>.
+
+   Usage as a client: python gridmux.py PORT GET 3 rpm
+"""
+import sys
+import time
+import socket
+import threading
+import socketserver
+
+from hardware import NZXTGrid
+
+
+DEFAULT_MAXAGE = 2.0    # seconds
+POLL_TIMEOUT = 5.0      # the longest a client waits for a poll
+
+
+class GridMux():
+    """Serves the telemetry of the controller's Grids on a localhost TCP port, see the module description"""
+
+    def __init__(self, controller, port):
+        self.controller = controller
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Starts serving on a thread, returns False if the port cannot be used"""
+        try:
+            self.server = MuxServer(("127.0.0.1", self.port), MuxHandler)
+        except OSError as e:
+            print ("Could not start the Grid multiplexer on port {0}. {1}".format(self.port, str(e)))
+            return False
+        self.server.mux = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name="GridMux", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if (self.server):
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+        self.server = None
+        self.thread = None
+
+    def get(self, fan, field, maxage=DEFAULT_MAXAGE):
+        """Returns (value, age) of a fan reading not older than maxage, polls the fan if needed"""
+        if (not field in ["rpm", "voltage", "amperage"]):
+            raise ValueError("Unknown reading '{0}'".format(field))
+        c = self.controller
+        with c.gridslock:
+            if (fan < 1 or fan > len(c.grids) * NZXTGrid.NUM_FANS):
+                raise ValueError("No fan {0}".format(fan))
+            i = (fan - 1) // NZXTGrid.NUM_FANS
+            fanid = (fan - 1) % NZXTGrid.NUM_FANS + 1
+            grid = c.grids[i]
+            value, age = grid.telemetry.reading(fanid, field)
+            if (age is not None and age <= maxage):
+                return value, age
+            if (not grid.ok):
+                raise IOError("Grid at {0} is offline".format(grid.port))
+            requested = time.monotonic()
+            future = c.requesttelemetry(i, fanid, pollamperage=(field == "amperage"))
+        future.result(POLL_TIMEOUT)
+        value, age = grid.telemetry.reading(fanid, field)
+        if (age is None or age > time.monotonic() - requested):     # the poll has failed
+            raise IOError("Grid at {0} did not answer".format(grid.port))
+        return value, age
+
+    def fans(self):
+        """Returns (fan, rpm, voltage, amperage) for all fans of all Grids from the cache"""
+        c = self.controller
+        with c.gridslock:
+            res = []
+            for i in range(0, len(c.grids)):
+                for fanid, rpm, voltage, amperage in c.grids[i].telemetry.fandata():
+                    res.append((i * NZXTGrid.NUM_FANS + fanid, rpm, voltage, amperage))
+            return res
+
+
+
+class MuxServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    mux = None
+
+
+
+class MuxHandler(socketserver.StreamRequestHandler):
+    """Serves one client connection"""
+
+    def handle(self):
+        for line in self.rfile:
+            words = line.decode("ascii", "replace").split()
+            if (len(words) == 0): continue
+            command = words[0].upper()
+            if (command == "QUIT"): break
+            try:
+                if (command == "GET" and len(words) in [3, 4]):
+                    maxage = float(words[3]) if len(words) == 4 else DEFAULT_MAXAGE
+                    value, age = self.server.mux.get(int(words[1]), words[2].lower(), maxage)
+                    self.reply("OK {0} {1:.3f}".format(value, age))
+                elif (command == "FANS" and len(words) == 1):
+                    for fan in self.server.mux.fans():
+                        self.reply("{0} {1} {2} {3}".format(*fan))
+                    self.reply("END")
+                else:
+                    self.reply("ERR Unknown command: {0}".format(" ".join(words)))
+            except Exception as e:
+                self.reply("ERR {0}".format(str(e) or type(e).__name__))
+
+    def reply(self, text):
+        self.wfile.write((text + "\n").encode("ascii"))
+
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 3):
+        print(__doc__)
+        sys.exit(1)
+    with socket.create_connection(("127.0.0.1", int(sys.argv[1]))) as s:
+        f = s.makefile("rwb")
+        f.write((" ".join(sys.argv[2:]) + "\n").encode("ascii"))
+        f.flush()
+        for line in f:
+            line = line.decode("ascii").rstrip()
+            print(line)
+            if (sys.argv[2].upper() != "FANS" or line == "END" or line.startswith("ERR")): break
@@ -0,0 +1,148 @@
+"""NZXT Grid+ V2 protocol codec: pre-encoded request frames and response parsing that works on bytes directly.
+
+   Command            command sequence (hex)      return sequence (hex)
+   Init:              C0                      ->  21
+   Set fan voltage:   44 XX C0 00 00 NN NN    ->  01 - success, (tbc: 02 - error)
+   Get fan voltage:   84 XX                   ->  C0 00 00 NN NN
+   Get fan amperage:  85 XX                   ->  C0 00 00 NN NN
+   Get fan RPM:       8A XX                   ->  C0 00 00 RR RR
+
+   Parameters:
+     XX:    fan ID         (01, 02, 03, 04, 05, 06)
+     NN NN: volts/amperes  (07 50: 7.80V, 02 12: 2.18 amps)
+     RR RR: RPM in HEX     (05 28: 05*256 + 40 = 1064 RPM)
+"""
+import math
+import struct
+
+
+NUM_FANS = 6
+
+# Command codes
+CMD_HELLO = 0xC0
+CMD_SETVOLTAGE = 0x44
+CMD_VOLTAGE = 0x84
+CMD_AMPERAGE = 0x85
+CMD_RPM = 0x8A
+
+# Response frame kinds
+ACK = 1       # 01 - success, 02 - error
+HELLO = 2     # 21
+READING = 3   # C0 00 00 NN NN
+FRAME_LENGTH = {ACK: 1, HELLO: 1, READING: 5}
+
+ACK_OK = 0x01
+ACK_ERROR = 0x02
+HELLO_OK = 0x21
+READING_PREFIX = b"\xC0\x00\x00"
+READING_STRUCT = struct.Struct(">3sBB")     # prefix, high byte, low byte
+
+METRIC_NAMES = {CMD_RPM: "RPM", CMD_VOLTAGE: "voltage", CMD_AMPERAGE: "amperage"}
+COMMAND_NAMES = dict(METRIC_NAMES)
+COMMAND_NAMES.update({CMD_HELLO: "hello", CMD_SETVOLTAGE: "set voltage"})
+
+
+# Pre-encoded request frames
+HELLO_FRAME = bytes([CMD_HELLO])
+READ_FRAMES = dict([(code, [None] + [bytes([code, fanid]) for fanid in range(1, NUM_FANS+1)])
+                    for code in (CMD_RPM, CMD_VOLTAGE, CMD_AMPERAGE)])    # READ_FRAMES[code][fanid]
+
+
+def encodespeed(fanid, speed):
+    """Returns the 7-byte set fan voltage command for a speed in %"""
+    if speed > 100: speed = 100
+    if speed < 40: speed = 0
+
+    voltage = speed / 100.0 * 12                   # map speed to 12-volt range. 0V = 0%, 12V = 100%
+    voltage_dec, voltage_int = math.modf(voltage)  # split voltage into integer and decimal part
+    voltage_dec = voltage_dec / 10                 # double-digit decimal part is accepted by Grid. 11.50 = (11, 50)
+
+    #TODO: check voltage granularity (steps of 0.5?)
+    return bytes([CMD_SETVOLTAGE, fanid, 0xC0, 0x00, 0x00, int(voltage_int), int(voltage_dec)])
+
+
+# Set voltage commands for every fan and every whole speed %: SPEED_FRAMES[fanid][speed]
+SPEED_FRAMES = [None] + [
+    [encodespeed(fanid, speed) for speed in range(0, 101)] for fanid in range(1, NUM_FANS+1)
+]
+
+
+def speedframe(fanid, speed):
+    """Returns the set fan voltage command for a speed in %, looked up in SPEED_FRAMES where possible"""
+    if (speed == int(speed) and 0 <= speed <= 100 and 1 <= fanid <= NUM_FANS):
+        return SPEED_FRAMES[fanid][int(speed)]
+    return encodespeed(fanid, speed)
+
+
+def framevoltage(frame):
+    """Returns the voltage encoded in a set fan voltage command"""
+    return frame[5] + frame[6] / 100.0
+
+
+def pollcodes(pollrpm, pollvoltage, pollamperage):
+    """Returns the read command codes for the selected metrics, in the order they are polled"""
+    return [code for code, selected in ((CMD_RPM, pollrpm), (CMD_VOLTAGE, pollvoltage), (CMD_AMPERAGE, pollamperage)) if selected]
+
+
+_pollrequests = {}
+
+def pollrequest(fanids, codes):
+    """Returns all read commands for the given fans and command codes concatenated in one frame
+       (fan by fan, codes in the given order). Built once per combination."""
+    key = (tuple(fanids), tuple(codes))
+    request = _pollrequests.get(key)
+    if (request is None):
+        request = b"".join([READ_FRAMES[code][fanid] for fanid in key[0] for code in key[1]])
+        _pollrequests[key] = request
+    return request
+
+
+def decodereading(code, high, low):
+    """Converts the two value bytes of a reading: RPM is a 16-bit integer, volts/amperes are units + hundredths"""
+    if (code == CMD_RPM):
+        return (high << 8) | low
+    return high + low / 100.0
+
+
+def decodereadings(buf, count):
+    """Returns (high, low) value bytes of count consecutive reading frames in buf, None for invalid frames"""
+    res = []
+    view = memoryview(buf)
+    for i in range(0, count):
+        prefix, high, low = READING_STRUCT.unpack_from(view, i * 5)
+        res.append((high, low) if prefix == READING_PREFIX else None)
+    return res
+
+
+def isreading(buf):
+    return len(buf) == 5 and buf[0:3] == READING_PREFIX
+
+
+def splitframes(buf, kind):
+    """Splits received bytes into response frames of the expected kind, skipping bytes that cannot start one.
+       Returns (frames, incomplete tail to be continued by the next read, nr of bytes skipped)"""
+    buf = bytes(buf)
+    frames = []
+    pos = 0
+    if (kind == READING):
+        while True:
+            start = buf.find(READING_PREFIX, pos)
+            if (start < 0 or len(buf) - start < 5): break
+            frames.append(buf[start:start+5])
+            pos = start + 5
+        # the bytes between pos and the tail are garbage, the tail is the beginning of a frame
+        # that the next read may complete
+        tail = buf.find(READING_PREFIX, pos)
+        if (tail < 0):
+            tail = len(buf)
+            for keep in (2, 1):
+                if (len(buf) - keep >= pos and buf[len(buf)-keep:] == READING_PREFIX[0:keep]):
+                    tail = len(buf) - keep
+                    break
+        return frames, buf[tail:], tail - 5 * len(frames)
+
+    valid = (ACK_OK, ACK_ERROR) if kind == ACK else (HELLO_OK,)
+    for b in buf:
+        if (b in valid): frames.append(bytes([b]))
+    return frames, b"", len(buf) - len(frames)
+
@@ -0,0 +1,67 @@
+from array import array
+
+from gridproto import CMD_HELLO, CMD_SETVOLTAGE, CMD_RPM, CMD_VOLTAGE, CMD_AMPERAGE, COMMAND_NAMES
+
+
+class CommandStats():
+    """Per command type counters and latency histograms of one Grid, in fixed memory (two arrays).
+       All updates come from NZXTGrid._cmd() with the Grid's lock held, readers (dump) take no lock
+       and may see a call in the histogram that is not counted yet.
+
+       Calls are counted by the type of the first command sent; a pipelined poll is one call with many commands.
+       Latency is the time from the first write to the complete response of a call, including a resend.
+       Histogram bucket n counts latencies of 2^(n-1) .. 2^n - 1 microseconds, the last bucket everything above."""
+
+    TYPES = [CMD_HELLO, CMD_SETVOLTAGE, CMD_RPM, CMD_VOLTAGE, CMD_AMPERAGE]
+    COUNTERS = ["calls", "commands", "timeouts", "invalid", "bytesout", "bytesin"]
+    BUCKETS = 24         # up to 8 sec
+
+    def __init__(self):
+        self.index = dict([(self.TYPES[i], i) for i in range(0, len(self.TYPES))])
+        self.counters = array("Q", [0] * (len(self.TYPES) * len(self.COUNTERS)))
+        self.histogram = array("Q", [0] * (len(self.TYPES) * self.BUCKETS))
+
+    def record(self, code, commands, latency, timeouts, invalid, bytesout, bytesin):
+        """Counts one call. latency in seconds, timeouts is the nr of attempts that lacked some response frames,
+           invalid the nr of attempts that received bytes that were not a valid response"""
+        t = self.index.get(code)
+        if (t is None): return
+        bucket = min(int(latency * 1e6).bit_length(), self.BUCKETS - 1)
+        self.histogram[t * self.BUCKETS + bucket] += 1
+        c = t * len(self.COUNTERS)
+        self.counters[c] += 1
+        self.counters[c+1] += commands
+        self.counters[c+2] += timeouts
+        self.counters[c+3] += invalid
+        self.counters[c+4] += bytesout
+        self.counters[c+5] += bytesin
+
+    def counter(self, code, name):
+        return self.counters[self.index[code] * len(self.COUNTERS) + self.COUNTERS.index(name)]
+
+    def buckets(self, code):
+        t = self.index[code]
+        return self.histogram[t * self.BUCKETS:(t+1) * self.BUCKETS].tolist()
+
+    def percentile(self, code, q):
+        """Returns the upper bound of the latency percentile q (0..1) in seconds, None if there were no calls"""
+        buckets = self.buckets(code)
+        total = sum(buckets)
+        if (total == 0): return None
+        seen = 0
+        for n in range(0, len(buckets)):
+            seen += buckets[n]
+            if (seen >= q * total): return (1 << n) / 1e6
+        return None
+
+    def dump(self):
+        """Returns the statistics as text, one line per command type that has been used"""
+        lines = []
+        for code in self.TYPES:
+            if (self.counter(code, "calls") == 0): continue
+            lines.append("{0:12} calls: {1}, commands: {2}, timeouts: {3}, invalid: {4}, bytes out/in: {5}/{6}, "
+                         "latency p50 < {7:g} ms, p99 < {8:g} ms".format(COMMAND_NAMES[code],
+                self.counter(code, "calls"), self.counter(code, "commands"), self.counter(code, "timeouts"),
+                self.counter(code, "invalid"), self.counter(code, "bytesout"), self.counter(code, "bytesin"),
+                self.percentile(code, 0.5) * 1000, self.percentile(code, 0.99) * 1000))
+        return "\n".join(lines)
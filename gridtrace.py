@@ -0,0 +1,305 @@
+"""Serial traffic capture and replay for NZXT Grid.
+
+   A trace file starts with TRACE_MAGIC followed by records, each one a RECORD_STRUCT header and a payload:
+     COMMAND: a call to NZXTGrid._cmd(), payload = kind, count, request bytes
+     WRITE:   bytes written to the port
+     READ:    bytes returned by a single read from the port (may be empty)
+   Timestamps are nanoseconds since the start of the capture on the monotonic clock,
+   duration is the time the port call took (for COMMAND: 0).
+
+   Usage: python gridtrace.py dump TRACE
+          python gridtrace.py stats TRACE
+          python gridtrace.py replay TRACE [--realtime]
+"""
+import time
+import struct
+import argparse
+import threading
+
+from gridproto import FRAME_LENGTH, COMMAND_NAMES
+
+
+TRACE_MAGIC = b"PGTRACE\x01"
+RECORD_STRUCT = struct.Struct("<cQIH")    # type, timestamp ns, duration ns, payload length
+
+COMMAND = b"C"
+WRITE = b"W"
+READ = b"R"
+
+
+class TraceWriter():
+    """Appends records to a trace file. Records come from the Grid's I/O thread, start/stop from the controller"""
+
+    FLUSH_INTERVAL = 1.0   # seconds, so that an incident is on disk even if the app is killed
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.start = time.monotonic()
+        self.flushed = self.start
+
+    def record(self, rtype, start, end, payload=b""):
+        """Writes a record, start and end are time.monotonic() values"""
+        with self.lock:
+            if (self.file is None): return
+            timestamp = int((start - self.start) * 1e9)
+            duration = min(int((end - start) * 1e9), 0xFFFFFFFF)
+            self.file.write(RECORD_STRUCT.pack(rtype, timestamp, duration, len(payload)))
+            self.file.write(payload)
+            if (end - self.flushed > self.FLUSH_INTERVAL):
+                self.file.flush()
+                self.flushed = end
+
+    def command(self, kind, count, data):
+        now = time.monotonic()
+        self.record(COMMAND, now, now, bytes([kind, count]) + data)
+
+    def close(self):
+        with self.lock:
+            if (self.file): self.file.close()
+            self.file = None
+
+
+
+class RecordingSerial():
+    """Wraps a serial port: every write and read goes to the trace, everything else is passed through,
+       including attribute assignments made by NZXTGrid.open()"""
+
+    def __init__(self, com, trace):
+        self.__dict__["com"] = com
+        self.__dict__["trace"] = trace
+
+    def __getattr__(self, name):
+        return getattr(self.com, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.com, name, value)
+
+    def write(self, data):
+        start = time.monotonic()
+        try:
+            return self.com.write(data)
+        finally:
+            self.trace.record(WRITE, start, time.monotonic(), bytes(data))
+
+    def read(self, size=1):
+        start = time.monotonic()
+        data = self.com.read(size)
+        self.trace.record(READ, start, time.monotonic(), data)
+        return data
+
+
+
+def readtrace(path):
+    """Returns the list of records in a trace file: (type, timestamp, duration, payload), times in seconds.
+       A record cut short at the end of the file (the capture was interrupted) is ignored."""
+    with open(path, "rb") as f:
+        buf = f.read()
+    if (buf[0:len(TRACE_MAGIC)] != TRACE_MAGIC):
+        raise ValueError("{0} is not a Grid trace file".format(path))
+    records = []
+    view = memoryview(buf)
+    pos = len(TRACE_MAGIC)
+    while pos + RECORD_STRUCT.size <= len(buf):
+        rtype, timestamp, duration, length = RECORD_STRUCT.unpack_from(view, pos)
+        pos += RECORD_STRUCT.size
+        if (pos + length > len(buf)): break
+        records.append((rtype, timestamp / 1e9, duration / 1e9, bytes(view[pos:pos+length])))
+        pos += length
+    return records
+
+
+def exchanges(records):
+    """Groups records by _cmd() call: returns a list of (timestamp, kind, count, request, [records of the call])"""
+    res = []
+    for record in records:
+        rtype, timestamp, duration, payload = record
+        if (rtype == COMMAND):
+            res.append((timestamp, payload[0], payload[1], payload[2:], []))
+        elif (len(res) > 0):
+            res[-1][4].append(record)
+    return res
+
+
+def tracestats(records, baudrate=4800):
+    """Summarizes a trace: per command code the nr of calls, nr of calls that needed more than one write
+       (missing or garbled response) and the device latency of the single command calls that went through
+       at once: time between the end of the write and the end of the response, less the line time of the response.
+       Returns {code: (calls, retried, [latencies])}"""
+    stats = {}
+    for timestamp, kind, count, request, calls in exchanges(records):
+        code = request[0] if len(request) > 0 else None
+        ncalls, retried, latencies = stats.get(code, (0, 0, []))
+        writes = [r for r in calls if r[0] == WRITE]
+        if (len(writes) > 1): retried += 1
+        elif (len(writes) == 1 and count == 1):
+            w = calls.index(writes[0])
+            reads = [r for r in calls[w+1:] if r[0] == READ and len(r[3]) > 0]
+            if (len(reads) > 0):
+                writeend = writes[0][1] + writes[0][2]
+                readend = reads[-1][1] + reads[-1][2]
+                linetime = FRAME_LENGTH[kind] * 10.0 / baudrate
+                latencies.append(max(0.0, readend - writeend - linetime))
+        stats[code] = (ncalls + 1, retried, latencies)
+    return stats
+
+
+def tracelatency(records, baudrate=4800):
+    """Median device latency per command code, in the format GridLink accepts for latency"""
+    res = {}
+    for code, (calls, retried, latencies) in tracestats(records, baudrate).items():
+        if (code is not None and len(latencies) > 0):
+            res[code] = sorted(latencies)[len(latencies) // 2]
+    return res
+
+
+
+class ReplaySerial():
+    """Drop-in replacement for serial.Serial that plays back the reads of a trace.
+       NZXTGrid._cmd() calls are replayed in the recorded order (see replay()); every read returns what
+       the recorded read returned. Where the replayed code reads more than the recording has, the port
+       behaves like a line without data: the read times out. With realtime the reads take as long as they did."""
+
+    def __init__(self, records, realtime=False):
+        self.records = records
+        self.realtime = realtime
+        self.position = 0
+        self.mismatchCount = 0   # nr of writes that differ from the recording, or recorded records left unused
+        self.port = ""
+        self.baudrate = 4800
+        self.bytesize = 8
+        self.parity = "N"
+        self.stopbits = 1
+        self.timeout = 0.1
+        self.write_timeout = 0.1
+        self.is_open = False
+
+    @property
+    def closed(self):
+        return not self.is_open
+
+    def _next(self, rtype):
+        """Returns the next record if it has the given type"""
+        if (self.position < len(self.records) and self.records[self.position][0] == rtype):
+            return self.records[self.position]
+        return None
+
+    @property
+    def in_waiting(self):
+        record = self._next(READ)
+        return len(record[3]) if record else 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    reset_input_buffer = flushInput
+    reset_output_buffer = flushOutput
+
+    def nextcommand(self):
+        """Skips to the next recorded _cmd() call, returns (timestamp, kind, count, request) or None at the end"""
+        while self.position < len(self.records):
+            rtype, timestamp, duration, payload = self.records[self.position]
+            self.position += 1
+            if (rtype == COMMAND):
+                return timestamp, payload[0], payload[1], payload[2:]
+            self.mismatchCount += 1
+        return None
+
+    def write(self, data):
+        if (not self.is_open):
+            raise IOError("Port is not open")
+        record = self._next(WRITE)
+        if (record is None or record[3] != bytes(data)):
+            self.mismatchCount += 1
+        if (record):
+            self.position += 1
+            if (self.realtime): time.sleep(record[2])
+        return len(data)
+
+    def read(self, size=1):
+        if (not self.is_open):
+            raise IOError("Port is not open")
+        record = self._next(READ)
+        if (record is None):
+            time.sleep(self.timeout)
+            return b""
+        self.position += 1
+        if (self.realtime): time.sleep(record[2])
+        return record[3]
+
+
+
+def replay(path, realtime=False, verbose=True):
+    """Runs the _cmd() calls recorded in a trace through NZXTGrid again, fed by the recorded reads.
+       With realtime the calls are spaced the way they were recorded. Returns (NZXTGrid, nr of calls replayed)"""
+    from hardware import NZXTGrid
+    com = ReplaySerial(readtrace(path), realtime)
+    grid = NZXTGrid()
+    grid.com = com
+    grid.open("REPLAY")
+    start = time.monotonic()
+    first = None
+    calls = 0
+    while True:
+        command = com.nextcommand()
+        if (command is None): break
+        timestamp, kind, count, request = command
+        if (first is None): first = timestamp
+        if (realtime):
+            remaining = timestamp - first - (time.monotonic() - start)
+            if (remaining > 0): time.sleep(remaining)
+        grid.ok = True
+        resyncs = grid.resyncCount
+        response = grid._cmd(request, kind, count)
+        calls += 1
+        if (verbose and (not grid.ok or len(response) != count * FRAME_LENGTH[kind] or grid.resyncCount != resyncs)):
+            print("{0:10.3f}s  {1:12} {2} -> {3}, resyncs: {4}".format(timestamp, COMMAND_NAMES.get(request[0], "?"),
+                request.hex(), response.hex(), grid.resyncCount - resyncs))
+    grid.close()
+    return grid, calls
+
+
+def dump(records):
+    for rtype, timestamp, duration, payload in records:
+        if (rtype == COMMAND):
+            print("{0:10.6f}  {1:12} kind {2} count {3}".format(timestamp, COMMAND_NAMES.get(payload[2], "?"), payload[0], payload[1]))
+        else:
+            print("{0:10.6f}  {1} {2:8.3f} ms  {3}".format(timestamp, rtype.decode(), duration * 1000, payload.hex()))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspects and replays NZXT Grid traffic traces")
+    parser.add_argument("action", choices=["dump", "stats", "replay"])
+    parser.add_argument("trace")
+    parser.add_argument("--realtime", action="store_true", help="replay with the recorded timing")
+    args = parser.parse_args()
+
+    if (args.action == "dump"):
+        dump(readtrace(args.trace))
+    elif (args.action == "stats"):
+        stats = tracestats(readtrace(args.trace))
+        for code in sorted(stats.keys(), key=lambda c: -1 if c is None else c):
+            calls, retried, latencies = stats[code]
+            latencies.sort()
+            line = "{0:12} calls: {1}, retried: {2}".format(COMMAND_NAMES.get(code, "?"), calls, retried)
+            if (len(latencies) > 0):
+                line += ", device latency ms: median {0:.2f}, max {1:.2f}".format(
+                    latencies[len(latencies)//2] * 1000, latencies[-1] * 1000)
+            print(line)
+    else:
+        grid, calls = replay(args.trace, args.realtime)
+        print("Commands: {0}, errors: {1}, resyncs: {2}, discarded bytes: {3}, diverged from the trace: {4}".format(
+            calls, grid.errorCount, grid.resyncCount, grid.discardCount, grid.com.mismatchCount))
+        print(grid.stats.dump())
@@ -1,10 +1,14 @@
 import time
-import math
-import wmi
 import threading
 import serial
 from serial.tools import list_ports
-from pythoncom import CoInitialize, CoUninitialize
+
+from gridproto import (ACK, HELLO, READING, FRAME_LENGTH, ACK_OK, HELLO_OK, CMD_RPM, CMD_VOLTAGE, CMD_AMPERAGE,
+                       METRIC_NAMES, HELLO_FRAME, READ_FRAMES, speedframe, framevoltage, pollcodes, pollrequest,
+                       decodereading, decodereadings, isreading, splitframes)
+import gridproto
+from gridtrace import TraceWriter, RecordingSerial
+from gridstats import CommandStats
 
 
 def list_comports():
@@ -15,37 +19,39 @@ def list_comports():
 class NZXTGrid():
     """ Provides low-level access to NZXT Grid """
 
-    # NZXT Grid+ V2 accepts the following commands via a COM port, and returns the following values:
-    # Command            command sequence (hex)      return sequence (hex)
-    # Init:              C0                      ->  21
-    # Set fan voltage:   44 XX C0 00 00 NN NN    ->  01 - success, (tbc: 02 - error)
-    # Get fan voltage:   84 XX                   ->  C0 00 00 NN NN
-    # Get fan amperage:  85 XX                   ->  C0 00 00 NN NN
-    # Get fan RPM:       8A XX                   ->  C0 00 00 RR RR
-    #
-    # Parameters:
-    #   XX:    fan ID         (01, 02, 03, 04, 05, 06)
-    #   NN NN: volts/amperes  (07 50: 7.80V, 02 12: 2.18 amps)
-    #   RR RR: RPM in HEX     (05 28: 05*256 + 40 = 1064 RPM)
+    # NZXT Grid+ V2 command set and frame encoding: see gridproto
 
     ok = True
     errorMessage = ""
     errorCount = 0
     writeCount = 0   # nr of fan voltage writes
     readCount = 0    # nr of reads (voltage, amperage, rpm)
+    skipCount = 0    # nr of fan voltage writes skipped because Grid already has the same voltage
+    resyncCount = 0  # nr of commands repeated because their response was missing or garbled
+    discardCount = 0 # nr of stray bytes thrown away
     port = ""
-    com = serial.Serial()
-    lock = threading.Lock()
+    com = None
+    lock = None
+    trace = None     # TraceWriter while traffic is being captured, see capture()
+    quiet = False    # do not print errors, e.g. while probing ports that may not have a Grid attached
 
-    NUM_FANS = 6
+    NUM_FANS = gridproto.NUM_FANS    # per Grid
+    RESYNC_GRACE = 0.02   # time to wait for late bytes before resending a command, seconds
 
     def __init__(self):
-        pass
-
-    def open(self, port):
-        """Opens communication with the Grid on a specified port (e.g. "COM5")"""
-        print("Opening NZXT Grid at {}".format(port))
+        # every instance has its own port, several Grids can be used at the same time
+        self.com = serial.Serial()
+        self.lock = threading.Lock()
+        self.lastframe = {}   # fanid -> the last set voltage command acknowledged by Grid
+        self.scheduler = PollScheduler()
+        self.telemetry = TelemetryCache()
+        self.stats = CommandStats()
+
+    def open(self, port, timeout=0.1):
+        """Opens communication with the Grid on a specified port (e.g. "COM5"), timeout is the read timeout in seconds"""
+        if (not self.quiet): print("Opening NZXT Grid at {}".format(port))
         self.ok = True   # reset errors of any
+        if (port != self.port): self.lastframe = {}   # a different device, nothing is known about its voltages
         try:
             self.port = port
             self.com.port = port
@@ -53,16 +59,16 @@ class NZXTGrid():
             self.com.bytesize = serial.EIGHTBITS
             self.com.parity = serial.PARITY_NONE
             self.com.stopbits = serial.STOPBITS_ONE
-            self.com.timeout = 0.1
+            self.com.timeout = timeout
             self.com.write_timeout = 0.1
             self.com.open()
             self.com.flushInput()
             self.com.flushOutput()
         except Exception as e:
-            errtxt = e.args[0]
-            if errtxt.find("FileNotFoundError") >= 0:
+            errtxt = str(e)   # the first argument is an errno rather than a message on some platforms
+            if errtxt.find("FileNotFoundError") >= 0 or errtxt.find("No such file") >= 0:
                 self._err("Could not open port {0}. No device found.".format(port))
-            elif errtxt.find("PermissionError") >= 0:
+            elif errtxt.find("PermissionError") >= 0 or errtxt.find("Permission denied") >= 0:
                 self._err("Could not open port {0}. Access denied. The port may be in use by another application.".format(port))
             else:
                 self._err(str(e))
@@ -73,255 +79,335 @@ class NZXTGrid():
             self.com.close()
 
 
+    def capture(self, path):
+        """Records all traffic with Grid to a trace file (see gridtrace), path None stops recording.
+           The trace can be replayed offline with python gridtrace.py replay.
+           Recording into the same path goes on in the open trace, so settings resets do not truncate it"""
+        with self.lock:
+            if (self.trace and self.trace.path == path): return
+            if (self.trace):
+                self.com = self.com.com
+                self.trace.close()
+                self.trace = None
+            if (path):
+                try:
+                    self.trace = TraceWriter(path)
+                except Exception as e:
+                    print ("Could not capture Grid traffic to {0}. {1}".format(path, str(e)))
+                    return
+                self.com = RecordingSerial(self.com, self.trace)
+
+
+    def detach(self):
+        """The device has been unplugged: closes the port, the Grid stays offline until it is opened again"""
+        self.close()
+        self._err("Grid at {0} has been unplugged.".format(self.port))
+
+
     def _err(self, errtext):
         if self.ok: self.errorMessage = ""
         self.errorMessage += "NZXT Grid error: " + errtext + "\n"
-        print (errtext)
+        if (not self.quiet): print (errtext)
         self.ok = False
         self.errorCount += 1
 
 
-    def _cmd(self, data, response_length=1):
-        """Sends an arbitrary command to Grid and returns a response"""
-        response = []
+    def _cmd(self, data, kind=ACK, count=1):
+        """Sends one or more commands to Grid in a single write, returns the response frames concatenated.
+           kind is the shape of the expected response frames (see splitframes), count is the nr of frames expected.
+           Stray bytes on the line are skipped. If some frames are still missing, the input is drained and the
+           commands are sent once again (all commands are idempotent), so the link resyncs without reopening the port."""
+        response = b""
         try:
             with self.lock:
-                bytes = serial.to_bytes(data)
-                nbytes = self.com.write(bytes)
-                response = self.com.read(size=response_length)
+                if (not isinstance(data, bytes)): data = bytes(data)   # frames from gridproto are sent as they are
+                if (self.trace): self.trace.command(kind, count, data)
+                timeouts = 0
+                invalid = 0
+                skipped = self.discardCount
+                for attempt in range(0, 2):
+                    self._drain()
+                    if (attempt == 0): start = time.monotonic()
+                    discarded = self.discardCount
+                    nbytes = self.com.write(data)
+                    response = self._readframes(kind, count, len(data))
+                    if (self.discardCount != discarded): invalid += 1
+                    if (len(response) == count * FRAME_LENGTH[kind]): break
+                    timeouts += 1
+                    self.resyncCount += 1
+                    self._drain(self.RESYNC_GRACE)     # let late replies of this attempt arrive and throw them away
+                self.stats.record(data[0], count, time.monotonic() - start, timeouts, invalid,
+                                  len(data) * (attempt + 1), len(response) + self.discardCount - skipped)
         except Exception as e:
             self._err ("Failed to send command to grid. {0}.".format(str(e)))
         return response
 
 
+    def _drain(self, grace=0):
+        """Discards anything waiting in the input buffer, e.g. a late reply to a command that has timed out"""
+        if (grace > 0): time.sleep(grace)
+        waiting = self.com.in_waiting
+        if (waiting > 0):
+            self.com.read(size=waiting)
+            self.discardCount += waiting
+
+
+    def _readframes(self, kind, count, sent):
+        """Reads count response frames of a given kind, skipping garbage. sent is the nr of bytes just written"""
+        # a single read() gives up after com.timeout, so allow for the time the whole exchange needs
+        # on the wire: 10 bits per byte (start + 8 data + stop) in both directions
+        length = count * FRAME_LENGTH[kind]
+        linetime = (sent + length) * 10.0 / self.com.baudrate
+        deadline = time.monotonic() + linetime + self.com.timeout
+        frames = []
+        pending = b""
+        while len(frames) < count and time.monotonic() < deadline:
+            chunk = self.com.read(size=max(1, length - len(frames) * FRAME_LENGTH[kind] - len(pending)))
+            if (len(chunk) == 0): continue
+            parsed, pending, skipped = splitframes(pending + chunk, kind)
+            frames.extend(parsed)
+            self.discardCount += skipped
+        return b"".join(frames[0:count])
+
+
     def hello(self):
         """Handshake with the controller."""
-        data = [0xC0]
-        response = self._cmd(data, 1)
+        response = self._cmd(HELLO_FRAME, HELLO)
         if (not response or len(response) == 0):
             self._err ("No response from controller.")
-        elif response[0] != int("0x21", 16):
+        elif response[0] != HELLO_OK:
             self._err ("Failed to establish comms with controller. Invalid response: {0}".format(str(response)))
 
 
-    def setfanspeed(self, fanid, speed):
+    def setfanspeed(self, fanid, speed, force=False):
         """Sets speed in % for a given fanid.
            The speed % is mapped to fan voltage in the range of 0..12 Volts.
            40% is the mimimum to which Grid will react. 0% sets the fan speed to zero.
+           Many speeds map to the same voltage, the command is not sent if Grid already has it (unless forced).
         """
-        if speed > 100: speed = 100
-        if speed < 40: speed = 0
+        data = speedframe(fanid, speed)
+        if (not force and self.lastframe.get(fanid) == data):
+            self.skipCount += 1
+            return
 
-        voltage = speed / 100.0 * 12                   # map speed to 12-volt range. 0V = 0%, 12V = 100%
-        voltage_dec, voltage_int = math.modf(voltage)  # split voltage into integer and decimal part
-        voltage_dec = voltage_dec / 10                 # double-digit decimal part is accepted by Grid. 11.50 = (11, 50)
-
-        #TODO: check voltage granularity (steps of 0.5?)
-        data = [0x44, fanid, 0xC0, 0x00, 0x00, int(voltage_int), int(voltage_dec)]
-        response = self._cmd(data, 1)
+        self.lastframe.pop(fanid, None)    # unknown until acknowledged
+        response = self._cmd(data, ACK)
         self.writeCount += 1
         if (not response or len(response) == 0):
             self._err ("Failed to set fan speed. No response from controller.")
-        elif response[0] != int("0x01", 16):
+        elif response[0] != ACK_OK:
             self._err ("Failed to set fan speed. Invalid response: {0}".format(str(response)))
+        else:
+            self.lastframe[fanid] = data
+            self.scheduler.markchanged(fanid)
+
+
+    def verifyspeeds(self):
+        """Reads fan voltages back from Grid after a reconnect and compares them to the last acknowledged
+           set voltage commands. The ones that do not match (e.g. Grid has been power cycled) are forgotten.
+           Returns the list of fanids that need to be written again."""
+        fanids = sorted(self.lastframe.keys())
+        if (len(fanids) == 0): return []
+        fandata = self.poll(pollrpm=False, pollvoltage=True, pollamperage=False, fanids=fanids)
+        confirmed = []
+        for fanid, rpm, voltage, amperage in fandata:
+            frame = self.lastframe[fanid]
+            if abs(voltage - framevoltage(frame)) <= 0.5:   # Grid reports the measured voltage, not the exact setpoint
+                confirmed.append(fanid)
+        stale = [fanid for fanid in fanids if not fanid in confirmed]
+        for fanid in stale: del self.lastframe[fanid]
+        return stale
+
+
+    def set_fan_speeds(self, speeds, force=False):
+        """Sets speed in % for several fans at once, speeds is a dict of {fanid: speed}.
+           All commands that change anything are sent back-to-back, then the acknowledgements are collected.
+           Returns a dict of {fanid: True/False} telling which fans have been updated successfully.
+        """
+        res = {}
+        pending = []    # (fanid, command) in the order they are sent
+        for fanid, speed in speeds.items():
+            data = speedframe(fanid, speed)
+            if (not force and self.lastframe.get(fanid) == data):
+                self.skipCount += 1
+                res[fanid] = True
+            else:
+                self.lastframe.pop(fanid, None)    # unknown until acknowledged
+                pending.append((fanid, data))
+        if (len(pending) == 0):
+            return res
+
+        response = self._cmd(b"".join([data for _, data in pending]), ACK, len(pending))
+        self.writeCount += len(pending)
+
+        # Grid acknowledges every command with a single byte, in order. If some are missing, there is no telling
+        # which command went unanswered, so none of them counts as acknowledged
+        complete = len(response) == len(pending)
+        failed = []
+        for i in range(0, len(pending)):
+            fanid, data = pending[i]
+            res[fanid] = complete and response[i] == ACK_OK
+            if (res[fanid]):
+                self.lastframe[fanid] = data
+                self.scheduler.markchanged(fanid)
+            else:
+                failed.append(str(fanid))
+        if (len(failed) > 0):
+            self._err ("Failed to set fan speed for fan {0}. Response: {1}".format(", ".join(failed), str(response)))
+        return res
 
 
-    def poll(self, pollrpm=True, pollvoltage=True, pollamperage=True):
-        """Returns fan voltage, amperage and RPM for all 6 fans"""
+    def poll(self, pollrpm=True, pollvoltage=True, pollamperage=True, pipelined=False, fanids=None):
+        """Returns fan voltage, amperage and RPM for all 6 fans (or for the given list of fanids)"""
         # The process is slow due to low baud rate of the COM port.
         # Polling RPM, voltage and amperage for all 6 fans takes nearly 500 msec.
-        fandata = []
-
-        for fanid in range(1, NZXTGrid.NUM_FANS+1):
-            voltage = 0
-            amperage = 0
-            rpm = 0
+        if (fanids is None): fanids = range(1, NZXTGrid.NUM_FANS+1)
+        if (pipelined):
+            return self._pollpipelined(pollrpm, pollvoltage, pollamperage, fanids)
 
-            if (pollrpm):
-                cmd = [0x8A, fanid] # request RPM
-                response = self._cmd(cmd, response_length=5)
-                self.readCount += 1
-                if response and len(response) == 5:
-                    if (response[0]) == int("0xC0", 16) and (response[1]) == int("0x00", 16) and (response[2]) == int("0x00", 16):
-                        rpm = int(response[3])*256 + int(response[4])
-                else:
-                    self._err ("Failed to receive RPM data from controller. Invalid response: {0}".format(str(response)))
-                    break
-
-            if (pollvoltage):
-                cmd = [0x84, fanid] # request voltage
-                response = self._cmd(cmd, response_length=5)
-                self.readCount += 1
-                if response and len(response) == 5:
-                    if (response[0]) == int("0xC0", 16) and (response[1]) == int("0x00", 16) and (response[2]) == int("0x00", 16):
-                        voltage = float(response[3]) + float(response[4])/100
-                else:
-                    print ("Failed to receive voltage data from controller. Invalid response: {0}".format(str(response)))
-                    break
-
-            if (pollamperage):
-                cmd = [0x85, fanid] # request amperage
-                response = self._cmd(cmd, response_length=5)
+        codes = pollcodes(pollrpm, pollvoltage, pollamperage)
+        fandata = []
+        for fanid in fanids:
+            values = {CMD_RPM: 0, CMD_VOLTAGE: 0, CMD_AMPERAGE: 0}
+            for code in codes:
+                response = self._cmd(READ_FRAMES[code][fanid], READING)
                 self.readCount += 1
-                if response and len(response) == 5:
-                    if (response[0]) == int("0xC0", 16) and (response[1]) == int("0x00", 16) and (response[2]) == int("0x00", 16):
-                        amperage = float(response[3]) + float(response[4])/100
-                else:
-                    self._err ("Failed to receive amperage data from controller. Invalid response: {0}".format(str(response)))
-                    break
-
-            fandata.append((fanid, rpm, voltage, amperage))
+                if (not isreading(response)):
+                    self._err ("Failed to receive {0} data from controller. Invalid response: {1}".format(METRIC_NAMES[code], str(response)))
+                    return fandata
+                values[code] = decodereading(code, response[3], response[4])
+            fandata.append((fanid, values[CMD_RPM], values[CMD_VOLTAGE], values[CMD_AMPERAGE]))
 
         return fandata
 
 
+    def _pollpipelined(self, pollrpm, pollvoltage, pollamperage, fanids):
+        """Same as poll(), but queues all requests in one write and demultiplexes the response stream.
+           Saves the round trip latency of every command except the first one."""
+        codes = pollcodes(pollrpm, pollvoltage, pollamperage)
+        if (len(codes) == 0 or len(fanids) == 0):
+            return [(fanid, 0, 0, 0) for fanid in fanids]
+
+        count = len(fanids) * len(codes)
+        response = self._cmd(pollrequest(fanids, codes), READING, count)
+        self.readCount += count
+
+        # every response has the same shape (C0 00 00 NN NN) and Grid answers in request order,
+        # so the n-th frame of the stream belongs to the n-th request. That only holds for a complete stream:
+        # once a reply is missing, the frames after it can not be told apart, so the whole batch is dropped
+        if (len(response) != count * FRAME_LENGTH[READING]):
+            self._err ("Failed to receive fan data from controller. {0} of {1} responses received.".format(
+                len(response) // FRAME_LENGTH[READING], count))
+            return []
+        readings = decodereadings(response, count)
+        fandata = []
+        position = 0
+        for fanid in fanids:
+            values = {CMD_RPM: 0, CMD_VOLTAGE: 0, CMD_AMPERAGE: 0}
+            for code in codes:
+                reading = readings[position] if position < len(readings) else None
+                if (reading is None):
+                    chunk = response[position*5:position*5+5]
+                    self._err ("Failed to receive {0} data from controller. Invalid response: {1}".format(METRIC_NAMES[code], str(chunk)))
+                    return fandata
+                position += 1
+                values[code] = decodereading(code, reading[0], reading[1])
+            fandata.append((fanid, values[CMD_RPM], values[CMD_VOLTAGE], values[CMD_AMPERAGE]))
 
-# WMI cookbook:
-# http://timgolden.me.uk/python/wmi/cookbook.html
-
-class Hamon():
-    """Provides WMI interface to Libre Hardware Monitor and its temperature readings"""
-    ok = True
-    errorMessage = ""
-    initialized = False
-    hamon = None
-    devicenames = []
-    sensors = []
-
-    def __init__(self):
-        try:
-            CoInitialize()
-            self.hamon = wmi.WMI(namespace="root\LibreHardwareMonitor")
-            self.initialized = True
-        except Exception as e:
-            self._err ("Error: Libre Hardware Monitor not installed.\nPlease install it and restart the application.")
-
-
-    def _err(self, errtext):
-        self.ok = False
-        self.errorMessage = errtext
-        print (errtext)
-
-
-    def update(self):
-        # run only if initialization was successful
-        if (self.initialized):
-            # it is possible that at boot time Libre Hardware Monitor starts later than the app,
-            # so the sensor readings will not be available immediately - we need to retry until the monitor is loaded.
-            self.ok = True  # reset error
-
-            # request temperature sensor data, only request what's really needed - this is a slow operation:
-            # the next one line consumes 95% of CPU time during each control cycle:
-            _sensors = self.hamon.Sensor(["Parent", "Name", "Value"], SensorType="Temperature")
-
-            # sort by parent and then by name
-            _sensors = sorted(_sensors, key = lambda x: (x.Parent, x.Name))
-            self.sensors = [Sensor(x) for x in _sensors]
-            self.devicenames = set([x.parent for x in self.sensors])
-
-
-    def createSignal(self, signature):
-        """Returns a list of sensor names matching the required signature
-           The signature is either "CPU" or "GPU" """
-        res = []
-        for device in self.devicenames:
-            count = 0
-            matches = 0
-            deviceItems = []
-            for s in self.sensors:
-                if s.parent == device:
-                    count += 1
-                    if s.isMatch(signature):
-                        deviceItems.append("{0}, {1}".format(s.parent, s.name))
-                        matches += 1
-            if count == matches:
-                res.append(device)
-                #res.append("{0}, *".format(device))
-            else:
-                res.extend(deviceItems)
-        return res
+        return fandata
 
 
-    def updateSignals(self, signals):
-        """Updates signal values in the supplied dictionary of signals"""
-        totalsum = 0
-        for sname in signals.keys():
-            s = signals[sname]
-            val = self.getSignalValue(s.fn, s.sensors)
-            s.update(val)
-            totalsum += val
-
-        # if no readings were found assume Libre Hardware Monitor is not (yet) running
-        if (totalsum == 0):
-            self._err("The data from Libre Hardware Monitor is unavailable.\nPlease check if it is running.")
-
-
-    def getSignalValue(self, fn, sensors):
-        """Returns signal value for a given signal function (max, avg) and list of sensors"""
-        count = 0
-        max = 0
-        avg = 0
-        for s in sensors:
-            parts = [x.strip() for x in s.split (",")]
-            parts.append("")
-            devicename = parts[0]
-            sensorname = parts[1]
-            if sensorname == "*": sensorname = ""
-            for _s in self.sensors:
-                if _s.parent == devicename and ( sensorname == "" or _s.name == sensorname):
-                    val = _s.value
-                    if (val > max): max = val
-                    avg += val
-                    count += 1
-
-        res = max
-        if (fn == "avg"): res = avg / float(count)
-        return res
+    def polltelemetry(self, fanids, pollrpm=True, pollvoltage=True, pollamperage=True, pipelined=False):
+        """Polls the given fans into the telemetry cache and updates the poll time estimate of the scheduler"""
+        if (len(fanids) == 0): return
+        start = time.monotonic()
+        fandata = self.poll(pollrpm, pollvoltage, pollamperage, pipelined, fanids=fanids)
+        if (len(fandata) == len(fanids)):
+            self.scheduler.measure(len(fanids), time.monotonic() - start)
+        self.telemetry.update(fandata, pollrpm, pollvoltage, pollamperage)
 
 
-    def close(self):
-        CoUninitialize()
-        self.initialized = False
 
+class PollScheduler():
+    """Chooses which fans to poll during a control cycle so that telemetry fits into a serial time budget.
+       Fans whose speed has just been changed go first, the rest take turns across cycles."""
+    cursor = 0          # round robin position: the fan to start with during the next cycle
+    fantime = 0.05      # estimated time it takes to poll one fan, seconds. Updated as polls complete
 
+    def __init__(self):
+        self.changed = set()   # fans updated since they were last polled
 
-class Sensor():
-    """Sensor value wrapper"""
-    parent = ""
-    name = ""
-    value = 0
+    def markchanged(self, fanid):
+        self.changed.add(fanid)
 
-    def __init__(self, wmiSensor):
-        self.parent = wmiSensor.Parent
-        self.name = wmiSensor.Name
-        self.value = wmiSensor.Value
+    def measure(self, count, elapsed):
+        """Feeds the time spent on polling count fans into the per-fan estimate (moving average)"""
+        self.fantime = 0.7 * self.fantime + 0.3 * elapsed / count
 
-    def isMatch(self, sig):
-        return self.name.find(sig) >= 0
+    def select(self, fanids, budget):
+        """Returns the list of fans to poll, at least one if there are any fans to poll at all"""
+        fanids = list(fanids)
+        if (len(fanids) == 0): return []
+        maxcount = max(1, int(budget / self.fantime))
 
-    def __repr__(self):
-        return "<{0}, {1}, {2}>".format(self.parent, self.name, self.value)
+        # changed fans go first, but leave one slot to round robin so that steady fans do not starve
+        changed = [fanid for fanid in fanids if fanid in self.changed]
+        reserved = 1 if (maxcount > 1 and len(changed) < len(fanids)) else 0
+        selected = changed[0:maxcount-reserved]
 
+        # continue round robin from where the previous cycle stopped
+        ordered = sorted(fanids, key = lambda fanid: (fanid < self.cursor, fanid))
+        for fanid in ordered:
+            if (len(selected) >= maxcount): break
+            if (fanid in selected): continue
+            selected.append(fanid)
+            self.cursor = fanid + 1
 
+        self.changed.difference_update(selected)
+        return sorted(selected)
 
-class Signal():
-    """Calculates and holds signal value"""
-    name = ""
-    fn = ""
-    sensornames = []
-    value = 0
-    min = 0
-    max = 0
 
-    def __init__(self, name, fn, sensors):
-        self.name = name
-        self.fn = fn
-        self.sensors = sensors
 
-    def update(self, value):
-        self.value = value
-        if (self.min == 0): self.min = value
-        if (self.max == 0): self.max = value
-        if (value < self.min): self.min = value
-        if (value > self.max): self.max = value
+class TelemetryCache():
+    """Holds the most recent fan readings and the time each of them was taken.
+       Written by whoever polls Grid, read by the UI and anybody else without touching the COM port."""
+    FIELDS = ["rpm", "voltage", "amperage"]
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict([(fanid, [0, 0, 0]) for fanid in range(1, NZXTGrid.NUM_FANS+1)])
+        self.timestamps = dict([(fanid, [None, None, None]) for fanid in range(1, NZXTGrid.NUM_FANS+1)])
+
+    def update(self, fandata, pollrpm=True, pollvoltage=True, pollamperage=True):
+        """Stores (fanid, rpm, voltage, amperage) tuples as returned by NZXTGrid.poll(), only the polled fields are updated"""
+        now = time.monotonic()
+        polled = [pollrpm, pollvoltage, pollamperage]
+        with self.lock:
+            for fanid, rpm, voltage, amperage in fandata:
+                readings = [rpm, voltage, amperage]
+                for i in range(0, len(readings)):
+                    if (polled[i]):
+                        self.values[fanid][i] = readings[i]
+                        self.timestamps[fanid][i] = now
+
+    def fandata(self):
+        """Returns (fanid, rpm, voltage, amperage) for all fans, the same format NZXTGrid.poll() uses"""
+        with self.lock:
+            return [tuple([fanid] + self.values[fanid]) for fanid in range(1, NZXTGrid.NUM_FANS+1)]
+
+    def age(self, fanid, field):
+        """Returns the age of a field ("rpm", "voltage", "amperage") in seconds, None if it has never been read"""
+        i = self.FIELDS.index(field)
+        with self.lock:
+            timestamp = self.timestamps[fanid][i]
+        if (timestamp is None): return None
+        return time.monotonic() - timestamp
+
+    def reading(self, fanid, field):
+        """Returns (value, age) of a field, age is None if it has never been read"""
+        i = self.FIELDS.index(field)
+        with self.lock:
+            value = self.values[fanid][i]
+            timestamp = self.timestamps[fanid][i]
+        if (timestamp is None): return value, None
+        return value, time.monotonic() - timestamp
@@ -0,0 +1,69 @@
+import os
+import threading
+
+from hardware import list_comports
+
+
+class HotplugWatcher(threading.Thread):
+    """Notices the serial devices of the Grids appear and disappear, so that a replugged Grid is reconnected
+       right away and an unplugged one is not retried in vain.
+       Device paths (/dev/ttyUSB0, /dev/serial/by-id/..., a PTY symlink) are checked with a stat() every PERIOD,
+       which costs next to nothing. Ports that are not paths (COM5 on Windows) are looked up in the list of
+       COM ports, which is more expensive and is done every LIST_PERIOD.
+       callback(port, present) is called on the watcher thread for every change."""
+
+    PERIOD = 0.25        # seconds
+    LIST_PERIOD = 1.0
+
+    def __init__(self, callback):
+        threading.Thread.__init__(self, name="HotplugWatcher", daemon=True)
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.ports = []
+        self.state = {}      # port -> True if the device is present
+        self.shutdown = threading.Event()
+
+    def watch(self, ports):
+        """Sets the ports to watch. The current state of new ports is taken as it is, without a callback"""
+        with self.lock:
+            self.ports = list(ports)
+            self.state = dict([(port, self.state.get(port, True)) for port in self.ports])
+        self.check(notify=False)
+
+    def present(self, port):
+        """Returns False if the device of a port is known to be missing"""
+        with self.lock:
+            return self.state.get(port, True)
+
+    def check(self, notify=True, listports=True):
+        """Looks up all ports, calls back for those that have appeared or disappeared"""
+        with self.lock:
+            ports = list(self.ports)
+        comports = None
+        changes = []
+        for port in ports:
+            if (os.path.isabs(port)):
+                present = os.path.exists(port)
+            elif (listports):
+                if (comports is None): comports = set([p.device for p in list_comports()])
+                present = port in comports
+            else:
+                continue
+            with self.lock:
+                if (not port in self.state or self.state[port] == present): continue
+                self.state[port] = present
+            changes.append((port, present))
+        if (notify):
+            for port, present in changes: self.callback(port, present)
+
+    def run(self):
+        """threadproc"""
+        ticks = 0
+        listevery = max(1, int(round(self.LIST_PERIOD / self.PERIOD)))
+        while not self.shutdown.wait(self.PERIOD):
+            ticks += 1
+            self.check(listports=(ticks % listevery == 0))
+
+    def stop(self):
+        self.shutdown.set()
+        self.join()
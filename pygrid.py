@@ -1,6 +1,7 @@
 import os
 import sys
 import math
+import multiprocessing
 
 import PyQt5.QtCore as QtCore
 from PyQt5.QtGui import QPixmap, QIcon
@@ -11,7 +12,7 @@ from ui import resources
 from ui.wnd import Ui_Dialog
 from settings import AppSettings
 from controller import Controller
-from hardware import list_comports, NZXTGrid, Hamon
+from hardware import list_comports, NZXTGrid
 from util import StrStream
 
 
@@ -138,6 +139,9 @@ class MainWindow(QMainWindow):
 
 
     def toggleportsandsensors(self):
+        # all sensors are read while they are listed, otherwise only those the signals need
+        self.controller.showsensors = self.ui.portsandsensorscheckBox.isChecked()
+        self.controller.wakeup.set()
         self.ui.statusEdit.setPlainText("updating...")
 
 
@@ -166,9 +170,10 @@ class MainWindow(QMainWindow):
         signals = data["signals"]
         fans = data["fans"]
         speed = data["fanspeed"]
+        fanage = data["fanage"]
         fannames = []
-        for f in range (1, NZXTGrid.NUM_FANS+1):
-            fan = self.appsettings.settings["policy"]["fan"+str(f)]
+        for f in range (1, len(speed)+1):
+            fan = self.appsettings.settings["policy"].get("fan"+str(f), {"name": ""})
             fannames.append(fan["name"])
 
         with StrStream() as x:  # dump the current status into a string:
@@ -184,15 +189,26 @@ class MainWindow(QMainWindow):
                 print (self.controller.errorMessage)
                 print()
                 print()
-            if (not self.controller.hamon.ok):
+            snapshot = self.controller.acquisition.latest
+            if (not snapshot.ok):
                 err = True
-                print (self.controller.hamon.errorMessage)
+                print (snapshot.errorMessage)
+                if (not snapshot.initialized): print (self.controller.acquisition.status())
                 print()
                 print()
-            if (not self.controller.grid.ok):
-                err = True
-                print (self.controller.grid.errorMessage)
+            elif (len(snapshot.warnings) > 0):
+                # a part of the sensors has failed, fans whose signals do not use it are controlled as usual
+                print ("\n".join(snapshot.warnings))
                 print()
+            griderr = False
+            for grid, policy in zip(self.controller.grids, self.controller.gridpolicies):
+                if (not grid.ok):
+                    griderr = True
+                    print (grid.errorMessage)
+                    print (policy.status())
+                    print()
+            if (griderr):
+                err = True
                 self.listports()
 
             if (not err):
@@ -203,12 +219,13 @@ class MainWindow(QMainWindow):
                     self.listports()
                     self.printsensors(sensors)
                 self.printsignals(signals)
-                self.printfans(fannames, fans, speed)
+                self.printfans(fannames, fans, speed, fanage)
                 if (portsandsensors and self.appsettings.gridstats):
-                    print("\nGrid reads: {0}, writes: {1}, errors: {2}".format(
-                        self.controller.grid.readCount,
-                        self.controller.grid.writeCount,
-                        self.controller.grid.errorCount))
+                    print()
+                    for grid in self.controller.grids:
+                        print("Grid {0} reads: {1}, writes: {2}, skipped writes: {3}, errors: {4}, resyncs: {5}".format(
+                            grid.port, grid.readCount, grid.writeCount, grid.skipCount, grid.errorCount, grid.resyncCount))
+                        print(grid.stats.dump())
             else:
                 self.ui.statusEdit.setStyleSheet(self.COLOR_ERR)
 
@@ -235,7 +252,9 @@ class MainWindow(QMainWindow):
             print ("  No data available")
         else:
             for sensor in sensors:
-                print("  {:20}{:20}{:>4.1f}".format(sensor.parent, sensor.name, sensor.value))
+                stale = sensor.stale
+                age = "" if stale is None else "  ({0:.0f}s old)".format(sensors.timestamp - stale)
+                print("  {:20}{:20}{:>4.1f}{}".format(sensor.parent, sensor.name, sensor.value, age))
         print ()
 
 
@@ -243,21 +262,27 @@ class MainWindow(QMainWindow):
         print(u"Temperature signals (\u2103):")
         for sname in signals.keys():
             s = signals[sname]
-            print("  {0} - {1:>4.1f}  [{2:>4.1f} .. {3:>4.1f}]".format(sname.upper(), s.value, s.min, s.max))
+            unavailable = "" if s.available else "  (unavailable)"
+            print("  {0} - {1:>4.1f}  [{2:>4.1f} .. {3:>4.1f}]{4}".format(sname.upper(), s.value, s.min, s.max, unavailable))
         if len(signals) == 0:
             print ("  No data available")
         print ()
 
 
-    def printfans(self, fannames, fandata, speeddata):
+    STALE_AGE = 5   # fan readings older than that many seconds are marked in the status panel
+
+    def printfans(self, fannames, fandata, speeddata, agedata):
         print ("Fans:")
         index = 0
         for d in fandata:
             fanid, rpm, voltage, amperage = d
             fanname = fannames[index]
             fanspeed = speeddata[index]
+            age = agedata[index]
+            stale = ""
+            if (age is not None and age > self.STALE_AGE): stale = "  ({0:.0f}s old)".format(age)
             if (fanname != ""):
-                print ("  {0:14} {1:4.0f}% {2:7d} rpm {3:8.2f} V".format(fanname, fanspeed, rpm, voltage))  #amperage*1000
+                print ("  {0:14} {1:4.0f}% {2:7d} rpm {3:8.2f} V{4}".format(fanname, fanspeed, rpm, voltage, stale))  #amperage*1000
             index += 1
         if len(fandata) == 0:
             print("  No fan data available")
@@ -354,6 +379,7 @@ def pause():
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()    # the sensor process of the frozen app starts here
     ui = True
     print(APP_TITLE)
 
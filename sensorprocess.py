@@ -0,0 +1,350 @@
+import os
+import mmap
+import time
+import struct
+import tempfile
+import itertools
+import multiprocessing
+
+from sensors import createsource, SensorCatalog, SensorSnapshot
+from acquisition import SensorAcquisition, errorsnapshot
+from util import ReconnectPolicy
+
+try:
+    import win32api
+    import win32process
+except ImportError:
+    win32process = None     # Windows only, the memory limit is not enforced without it
+
+
+class SensorRing():
+    """Shared memory the sensor worker process writes its samples into, a ring of RING_SLOTS slots.
+       The memory is a named mapping backed by the paging file on Windows and a file on tmpfs (/dev/shm)
+       elsewhere, so it works with every Python version PyGrid supports.
+
+       Every slot is a seqlock: its seq is odd while the worker writes it and 2n+2 once sample n is complete.
+       The header holds the number of the last complete sample. Readers take the values of a slot in place,
+       without a copy; a slot is only rewritten RING_SLOTS samples later, valid() tells whether that has happened."""
+
+    RING_SLOTS = 8
+    CAPACITY = 4096     # max nr of sensors
+    HEADER = struct.Struct("<Q")                # nr of the last complete sample
+    SLOT = struct.Struct("<QQQdQQ")             # seq, pid of the worker, state id, timestamp, memory usage, nr of values
+    HEADER_SIZE = 64
+    SLOT_SIZE = SLOT.size + 8 * CAPACITY
+    SIZE = HEADER_SIZE + RING_SLOTS * SLOT_SIZE
+
+    def __init__(self, name=None):
+        """Creates the ring, or attaches to the one of that name"""
+        self.owner = name is None
+        self.name = "pygrid-sensors-{0}-{1}".format(os.getpid(), next(_rings)) if name is None else name
+        self.path = None
+        if (os.name == "nt"):
+            self.mmap = mmap.mmap(-1, self.SIZE, tagname=self.name)
+        else:
+            shm = "/dev/shm"
+            self.path = os.path.join(shm if os.path.isdir(shm) else tempfile.gettempdir(), self.name)
+            fd = os.open(self.path, os.O_RDWR | (os.O_CREAT | os.O_TRUNC if self.owner else 0), 0o600)
+            try:
+                if (self.owner): os.ftruncate(fd, self.SIZE)
+                self.mmap = mmap.mmap(fd, self.SIZE)
+            finally:
+                os.close(fd)
+
+    def slotoffset(self, n):
+        return self.HEADER_SIZE + (n % self.RING_SLOTS) * self.SLOT_SIZE
+
+    def last(self):
+        """Returns the nr of the last complete sample"""
+        return self.HEADER.unpack_from(self.mmap, 0)[0]
+
+    def write(self, pid, stateid, timestamp, memory, values):
+        """Writes a sample of values (array of doubles) into the next slot"""
+        n = self.last() + 1
+        offset = self.slotoffset(n)
+        count = min(len(values), self.CAPACITY)
+        self.SLOT.pack_into(self.mmap, offset, 2 * n + 1, pid, stateid, timestamp, memory, count)
+        start = offset + self.SLOT.size
+        self.mmap[start:start + 8 * count] = memoryview(values).cast("B")[:8 * count]
+        struct.pack_into("<Q", self.mmap, offset, 2 * n + 2)
+        self.HEADER.pack_into(self.mmap, 0, n)
+
+    def read(self, n):
+        """Returns (pid, state id, timestamp, memory usage, values) of sample n, values as a memoryview of doubles
+           into the slot. None if the slot has been rewritten since or is being written"""
+        offset = self.slotoffset(n)
+        seq, pid, stateid, timestamp, memory, count = self.SLOT.unpack_from(self.mmap, offset)
+        if (seq != 2 * n + 2 or count > self.CAPACITY): return None
+        start = offset + self.SLOT.size
+        values = memoryview(self.mmap)[start:start + 8 * count].cast("d")
+        if (not self.valid(n)): return None
+        return pid, stateid, timestamp, memory, values
+
+    def valid(self, n):
+        """Returns True if the slot still holds sample n"""
+        return struct.unpack_from("<Q", self.mmap, self.slotoffset(n))[0] == 2 * n + 2
+
+    def close(self):
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass    # a snapshot still refers to the memory, it goes away along with the last one
+        if (self.owner and self.path):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+
+class SharedSnapshot(SensorSnapshot):
+    """A SensorSnapshot whose values are those of a SensorRing slot, read in place"""
+
+    def __init__(self, state, catalog, ring, n, timestamp, values):
+        self.name = state["name"]
+        self.ok = state["ok"]
+        self.errorMessage = state["errorMessage"]
+        self.initialized = state["initialized"]
+        self.stale = state["stale"]
+        self.warnings = state["warnings"]
+        self.catalog = catalog
+        self.values = values
+        self.timestamp = timestamp
+        self.ring = ring
+        self.n = n
+
+    def valid(self):
+        """Returns False once the worker has rewritten the slot, RING_SLOTS samples later"""
+        return self.ring.valid(self.n)
+
+    def updateSignals(self, signals):
+        res = SensorSnapshot.updateSignals(self, signals)
+        # the signals may have been calculated from a torn sample if the slot has been rewritten meanwhile
+        return res and self.valid()
+
+
+
+class SensorProcess(SensorAcquisition):
+    """SensorAcquisition that reads the sensor source in a worker process, enabled with "process": true in
+       the sensors settings. The source (e.g. WMI/COM) then neither shares the GIL with the controller and the UI
+       nor leaks handles into the PyGrid process. The worker writes its samples into a SensorRing, this thread
+       publishes them as SharedSnapshots; anything else (sensor names, errors) comes through a pipe, only when
+       it changes.
+
+       A watchdog restarts the worker if it dies, if it has not written a sample for HANG_TIMEOUT seconds,
+       or if it uses more memory than "memorylimit" (MB) of the settings."""
+
+    PERIOD = 0.1            # seconds between checks of the ring
+    SAMPLE_PERIOD = SensorAcquisition.PERIOD    # seconds between samples of the worker
+    HANG_TIMEOUT = 20.0     # seconds, long enough for a slow WMI connect
+    MEMORY_LIMIT = 256      # MB, default
+
+    def __init__(self, config, selectors=None, createsource=createsource):
+        SensorAcquisition.__init__(self, config, selectors, createsource)
+        self.name = "SensorProcess"
+        self.context = multiprocessing.get_context("spawn")
+        self.ring = SensorRing()
+        self.worker = None              # multiprocessing Process
+        self.connection = None          # pipe to the worker
+        self.workerselectors = None     # as sent to the worker
+        self.kicked = False
+        self.heartbeat = 0              # time.monotonic() when the worker has started or written its last sample
+        self.last = self.ring.last()    # nr of the last sample published
+        self.state = None               # of the worker: name, ok, errorMessage... as sent through the pipe
+        self.stateid = 0
+        self.catalog = None
+        self.sourcepolicy = ReconnectPolicy()   # copy of the reconnect policy of the worker, for status()
+        self.restarts = 0
+
+    def kick(self):
+        self.kicked = True
+        SensorAcquisition.kick(self)
+
+    def status(self):
+        if (self.worker is None or self.policy.state != ReconnectPolicy.CLOSED): return self.policy.status()
+        return self.sourcepolicy.status()
+
+    def startworker(self, config):
+        self.sourceconfig = config      # before it may fail, so that the next attempt waits for the backoff
+        self.connection, child = self.context.Pipe()
+        self.worker = self.context.Process(target=work, name="PyGrid sensors", daemon=True,
+                                           args=(self.ring.name, config, self.createsource, self.selectors, self.SAMPLE_PERIOD, child))
+        self.worker.start()
+        child.close()
+        self.workerselectors = self.selectors
+        self.kicked = False
+        self.heartbeat = time.monotonic()
+        self.state = None
+        self.stateid = 0
+
+    def stopworker(self, reason=None):
+        """Stops the worker, kills it if it does not stop in time (e.g. hung)"""
+        if (reason): print ("Restarting the sensor process: {0}".format(reason))
+        try:
+            self.connection.send(("stop",))
+        except (OSError, ValueError):
+            pass
+        self.worker.join(1.0)
+        if (self.worker.is_alive()):
+            self.worker.terminate()
+            self.worker.join(1.0)
+        self.connection.close()
+        self.worker = None
+        if (reason): self.restarts += 1
+
+    def sample(self):
+        """Checks on the worker and publishes its latest sample"""
+        config = self.config
+        if (self.worker is not None and config != self.sourceconfig):
+            self.stopworker()
+        if (self.worker is not None and not self.worker.is_alive()):
+            exitcode = self.worker.exitcode
+            self.stopworker("exit code {0}".format(exitcode))
+            self.policy.result(False)
+            self.latest = errorsnapshot("Error: The sensor process has exited with code {0}.".format(exitcode))
+        if (self.worker is None):
+            if (not self.policy.ready() and config == self.sourceconfig): return
+            self.startworker(config)
+        try:
+            if (self.selectors != self.workerselectors):
+                self.workerselectors = self.selectors
+                self.connection.send(("select", self.workerselectors))
+            if (self.kicked):
+                self.kicked = False
+                self.connection.send(("kick",))
+            self.receive(0)
+        except (OSError, EOFError):
+            return      # the worker has gone, is restarted on the next call
+
+        now = time.monotonic()
+        n = self.ring.last()
+        sample = self.ring.read(n) if n != self.last else None
+        if (sample is not None and sample[0] == self.worker.pid):
+            pid, stateid, timestamp, memory, values = sample
+            try:
+                # the state the sample belongs to may still be in the pipe
+                while (self.stateid < stateid and self.receive(1.0)): pass
+            except (OSError, EOFError):
+                return
+            self.last = n
+            self.heartbeat = now
+            self.policy.result(True)
+            if (self.stateid == stateid and len(values) == len(self.catalog)):
+                self.latest = SharedSnapshot(self.state, self.catalog, self.ring, n, timestamp, values)
+                self.published.set()
+            limit = self.sourceconfig.get("memorylimit", self.MEMORY_LIMIT)
+            if (memory > limit * 1024 * 1024):
+                self.stopworker("{0:.0f} MB of memory in use, the limit is {1} MB".format(memory / 1024 / 1024, limit))
+                self.policy.result(False)   # backs off if even a new worker needs more
+        elif (now - self.heartbeat > self.HANG_TIMEOUT):
+            self.stopworker("no sample for {0:.0f} seconds".format(now - self.heartbeat))
+            self.policy.result(False)
+
+    def receive(self, timeout):
+        """Takes a state of the worker from the pipe, returns False if there is none within the timeout"""
+        if (not self.connection.poll(timeout)): return False
+        message, self.stateid, state = self.connection.recv()
+        if (state["keys"] is not None or self.state is None):
+            self.catalog = SensorCatalog(state["keys"] or [], state["unknown"] or ())
+        self.sourcepolicy.state, self.sourcepolicy.failures, self.sourcepolicy.nextattempt = state["policy"]
+        self.state = state
+        return True
+
+    def failed(self, e):
+        print ("Sensor process has failed: {0}".format(repr(e)))
+        if (self.worker): self.stopworker()
+        self.policy.result(False)
+        self.latest = errorsnapshot("Error: Sensor process has failed. {0}".format(repr(e)))
+        self.published.set()
+
+    def run(self):
+        """threadproc"""
+        while not self.shutdown:
+            self.wakeup.clear()
+            try:
+                self.sample()
+            except Exception as e:
+                self.failed(e)
+            self.wakeup.wait(self.PERIOD)
+        if (self.worker): self.stopworker()
+        self.ring.close()
+
+
+
+def memoryusage():
+    """Returns the memory in use by this process in bytes (resident set, working set on Windows), 0 if unknown"""
+    try:
+        if (win32process is not None):
+            return win32process.GetProcessMemoryInfo(win32api.GetCurrentProcess())["WorkingSetSize"]
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def work(ringname, config, createsource, selectors, period, connection):
+    """Entry point of the worker process: reads the source every period seconds, or right away
+       when the selectors change or it is kicked, until the pipe says stop or is closed"""
+    ring = SensorRing(ringname)
+    policy = ReconnectPolicy()
+    source = createsource({"sensors": config})
+    policy.result(source.initialized)
+    pid = os.getpid()
+    stateid = 0
+    laststate = None
+    lastgeneration = None
+    failed = False
+    due = 0
+    try:
+        while True:
+            if (connection.poll(max(0, due - time.monotonic()))):
+                message = connection.recv()
+                if (message[0] == "stop"): break
+                if (message[0] == "select"): selectors = message[1]
+                if (message[0] == "kick"): policy.kick()
+                due = min(due, time.monotonic() + MIN_PERIOD)
+                continue
+            due = time.monotonic() + period
+
+            # a source that has raised an exception is tried again after the backoff delay, the samples go on
+            if (not failed or policy.ready()):
+                try:
+                    if (not source.initialized and policy.ready()):
+                        source.connect()
+                        policy.result(source.initialized)
+                    if (selectors != source.selectors):
+                        source.select(selectors)
+                    source.update()
+                    if (failed): policy.result(True)
+                    failed = False
+                except Exception as e:
+                    source._err("Error: Sensor source {0} has failed. {1}".format(source.NAME, repr(e)))
+                    policy.result(False)
+                    failed = True
+
+            generation = source.catalog.generation
+            state = {"name": source.NAME, "ok": source.ok, "errorMessage": source.errorMessage,
+                     "initialized": source.initialized, "stale": source.stale, "warnings": source.warnings,
+                     "policy": (policy.state, policy.failures, policy.nextattempt), "keys": None, "unknown": None}
+            if (len(source.values) > SensorRing.CAPACITY):
+                state["ok"] = False
+                state["errorMessage"] = "Too many sensors: {0}, at most {1} are read.".format(len(source.values), SensorRing.CAPACITY)
+            if (state != laststate or generation != lastgeneration):
+                laststate = state
+                stateid += 1
+                message = dict(state)
+                if (generation != lastgeneration):
+                    message["keys"] = source.catalog.keys[:SensorRing.CAPACITY]
+                    message["unknown"] = source.catalog.unknown
+                    lastgeneration = generation
+                connection.send(("state", stateid, message))
+            ring.write(pid, stateid, time.monotonic(), memoryusage(), source.values)
+    except (OSError, EOFError):
+        pass    # PyGrid has gone
+    finally:
+        source.close()
+        ring.close()
+
+
+_rings = itertools.count(1)
+MIN_PERIOD = 0.2    # between samples taken early, so that a slot lasts at least RING_SLOTS * MIN_PERIOD seconds
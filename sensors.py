@@ -0,0 +1,961 @@
+import os
+import re
+import sys
+import time
+import json
+import gzip
+import errno
+import shlex
+import base64
+import queue
+import itertools
+import threading
+import subprocess
+import concurrent.futures
+from array import array
+import http.client
+from urllib.parse import urlsplit
+
+try:
+    import wmi
+    from pythoncom import CoInitialize, CoUninitialize
+except ImportError:
+    wmi = None    # Windows only: without it Hamon reports an error, other sources work as usual
+
+
+SOURCES = ["wmi", "hwmon", "http", "command", "file"]
+UNAVAILABLE = float("nan")  # value of a sensor without a current reading, e.g. of a failed backend of SensorAggregator
+
+_generations = itertools.count(1)    # catalog versions, unique across all sources
+
+
+def defaultsource():
+    return "wmi" if sys.platform == "win32" else "hwmon"
+
+
+def createsource(settings):
+    """Creates the temperature sensor source selected in the optional "sensors" settings:
+       Libre Hardware Monitor over WMI by default on Windows, Linux hwmon elsewhere,
+       a SensorAggregator if several backends are configured"""
+    config = settings.get("sensors", {})
+    if ("backends" in config):
+        return SensorAggregator(config["backends"])
+    source = config.get("source", defaultsource())
+    if (source == "hwmon"):
+        return HwmonSource(config.get("path"))
+    if (source == "http"):
+        return HttpSource(config.get("url"))
+    if (source == "command"):
+        return CommandSource(config)
+    if (source == "file"):
+        return FileSource(config)
+    return Hamon()
+
+
+
+class SensorCatalog():
+    """The set of sensors of a source: (parent, name) of every slot, sorted by parent and name, with the strings
+       interned. A catalog never changes, a source makes a new one with a new generation whenever its set of
+       sensors changes; from sample to sample only the values (an array indexed by slot) change.
+       Signal selectors ("device, sensor") are compiled into slots of the catalog once per generation."""
+
+    def __init__(self, keys, unknown=()):
+        """keys: (parent, name) of every sensor in the order the source reports them,
+           unknown: prefixes of sensor names whose sensors are not known yet (backends of SensorAggregator without readings)"""
+        keys = [(sys.intern(parent), sys.intern(name)) for parent, name in keys]
+        order = sorted(range(0, len(keys)), key=lambda i: keys[i])
+        self.sourcekeys = keys                          # in the order of the source
+        self.keys = [keys[i] for i in order]            # in the order of the slots
+        self.slots = [0] * len(keys)                    # slot of every sensor in the order of the source
+        for slot in range(0, len(order)): self.slots[order[slot]] = slot
+        self.generation = next(_generations)
+        self.devicenames = set([parent for parent, name in keys])
+        self.slotindex = None     # (parent, name) -> [slots] and parent -> [slots], built on demand
+        self.unknown = tuple(unknown)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def incomplete(self, selectors):
+        """Returns True if any of the selectors refers to sensors that are not known yet"""
+        return any([s.strip().startswith(prefix) for s in selectors for prefix in self.unknown])
+
+    def compileselectors(self, selectors):
+        """Returns the slots a list of "device, sensor" or "device" selectors refers to"""
+        if (self.slotindex is None):
+            bykey = {}
+            bydevice = {}
+            for slot in range(0, len(self.keys)):
+                bykey.setdefault(self.keys[slot], []).append(slot)
+                bydevice.setdefault(self.keys[slot][0], []).append(slot)
+            self.slotindex = (bykey, bydevice)
+        bykey, bydevice = self.slotindex
+        slots = []
+        for s in selectors:
+            devicename, sensorname = parseselector(s)
+            if (sensorname == ""):
+                slots.extend(bydevice.get(devicename, []))
+            else:
+                slots.extend(bykey.get((devicename, sensorname), []))
+        return slots
+
+
+
+def parseselector(selector):
+    """Splits a "device, sensor", "device, *" or "device" selector into (device, sensor), sensor is "" for all"""
+    parts = [x.strip() for x in selector.split (",")]
+    parts.append("")
+    if (parts[1] == "*"): parts[1] = ""
+    return parts[0], parts[1]
+
+
+
+class SensorSelection():
+    """The sensors a list of selectors refers to, see SensorSource.select()"""
+
+    def __init__(self, selectors):
+        self.devices = set()      # all sensors of these devices
+        self.keys = set()         # (device, sensor)
+        for s in selectors:
+            devicename, sensorname = parseselector(s)
+            if (sensorname == ""): self.devices.add(devicename)
+            else: self.keys.add((devicename, sensorname))
+
+    def matches(self, parent, name):
+        return parent in self.devices or (parent, name) in self.keys
+
+    def filter(self, readings):
+        """Returns the readings [(parent, name, value)] of the selected sensors"""
+        return [x for x in readings if x[0] in self.devices or (x[0], x[1]) in self.keys]
+
+
+
+class SensorSource():
+    """Base class of temperature sensor sources.
+       connect() sets initialized when the source is usable, it is called again (with backoff) while it is not.
+       update() refreshes self.values, the readings indexed by the slots of self.catalog; a source that has gone
+       away clears initialized. snapshot() copies the readings for the control loop, see SensorSnapshot.
+       select() limits the sensors that are read to those the signals need, a new source reads all of them."""
+    NAME = ""         # shown in error messages
+    ok = True
+    errorMessage = ""
+    initialized = False
+    catalog = SensorCatalog([])
+    values = array("d")
+    stale = {}        # device -> timestamp of the readings, for devices whose readings are older than the sample
+    warnings = []     # errors of parts of the source (e.g. a backend of SensorAggregator) that leave the rest working
+    selectors = None  # as passed to select()
+    selection = None  # SensorSelection of the selectors, None reads all sensors
+
+    def connect(self):
+        pass
+
+    def update(self):
+        pass
+
+    def close(self):
+        self.initialized = False
+
+
+    def _err(self, errtext):
+        self.ok = False
+        self.errorMessage = errtext
+        print (errtext)
+
+
+    def select(self, selectors):
+        """Limits the sensors read by update() to those the selectors ("device, sensor" or "device", as in signals)
+           refer to, None reads all of them. Takes effect with the next update(). Sources filter at the backend
+           where they can, the others drop the sensors that are not needed, so the catalog only holds the selected"""
+        self.selectors = None if selectors is None else list(selectors)
+        self.selection = None if selectors is None else SensorSelection(selectors)
+
+
+    def setreadings(self, readings):
+        """Stores readings, a list of (parent, name, value), into self.values. The readings may come in any order,
+           as long as it is the same from sample to sample: then they are written straight into their slots
+           and nothing is allocated. The catalog is only rebuilt if the list of sensors has changed"""
+        keys = self.catalog.sourcekeys
+        if (len(readings) == len(keys)):
+            slots = self.catalog.slots
+            values = self.values
+            for i in range(0, len(readings)):
+                parent, name, value = readings[i]
+                key = keys[i]
+                if (parent != key[0] or name != key[1]): break
+                values[slots[i]] = value
+            else:
+                return
+        self.catalog = SensorCatalog([(parent, name) for parent, name, value in readings])
+        self.values = array("d", bytes(8 * len(readings)))
+        for i in range(0, len(readings)):
+            self.values[self.catalog.slots[i]] = readings[i][2]
+
+
+    def snapshot(self, timestamp=None):
+        """Returns the current readings as a SensorSnapshot, timestamp defaults to now (time.monotonic)"""
+        return SensorSnapshot(self, time.monotonic() if timestamp is None else timestamp)
+
+
+    def createSignal(self, signature):
+        """Returns a list of sensor names matching the required signature
+           The signature is either "CPU" or "GPU" """
+        res = []
+        for device in self.catalog.devicenames:
+            count = 0
+            matches = 0
+            deviceItems = []
+            for parent, name in self.catalog.keys:
+                if parent == device:
+                    count += 1
+                    if name.find(signature) >= 0:
+                        deviceItems.append("{0}, {1}".format(parent, name))
+                        matches += 1
+            if count == matches:
+                res.append(device)
+                #res.append("{0}, *".format(device))
+            else:
+                res.extend(deviceItems)
+        return res
+
+
+
+class SensorSnapshot():
+    """Readings of a sensor source at one point in time, never changed once taken, so a snapshot can be handed
+       to other threads as it is. It holds the catalog of the source and a copy of its values, one array.
+       Signals are evaluated on snapshots. For the UI a snapshot is a sequence of Sensor views, made on demand."""
+
+    def __init__(self, source, timestamp):
+        self.name = source.NAME
+        self.ok = source.ok
+        self.errorMessage = source.errorMessage
+        self.initialized = source.initialized
+        self.catalog = source.catalog
+        self.values = array("d", source.values)
+        self.stale = source.stale
+        self.warnings = source.warnings
+        self.timestamp = timestamp
+
+    def age(self):
+        """Returns the age of the readings in seconds"""
+        return time.monotonic() - self.timestamp
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, slot):
+        if (slot < 0 or slot >= len(self.values)): raise IndexError(slot)
+        return Sensor(self, slot)
+
+
+    def updateSignals(self, signals):
+        """Updates signal values in the supplied dictionary of signals.
+           Returns False if no readings were found, i.e. the source is not (yet) running"""
+        totalsum = 0
+        for sname in signals.keys():
+            s = signals[sname]
+            if (s.generation != self.catalog.generation):
+                s.slots = self.catalog.compileselectors(s.sensors)
+                s.incomplete = self.catalog.incomplete(s.sensors)
+                s.generation = self.catalog.generation
+            val = UNAVAILABLE if s.incomplete else self.getSignalValue(s.fn, s.slots)
+            # an unavailable signal keeps its last value, the fans that follow it are handled by the controller
+            s.available = val == val
+            if (not s.available): continue
+            s.update(val)
+            totalsum += val
+        return totalsum != 0
+
+
+    def getSignalValue(self, fn, slots):
+        """Returns signal value for a given signal function (max, avg) and list of sensor slots,
+           UNAVAILABLE if a sensor has no current reading"""
+        max = 0
+        avg = 0
+        values = self.values
+        for slot in slots:
+            val = values[slot]
+            if (val != val): return UNAVAILABLE
+            if (val > max): max = val
+            avg += val
+
+        res = max
+        if (fn == "avg" and len(slots) > 0): res = avg / float(len(slots))
+        return res
+
+
+
+# WMI cookbook:
+# http://timgolden.me.uk/python/wmi/cookbook.html
+
+class Hamon(SensorSource):
+    """Provides WMI interface to Libre Hardware Monitor and its temperature readings"""
+    NAME = "Libre Hardware Monitor"
+    hamon = None
+
+    def __init__(self):
+        if (wmi is not None): CoInitialize()
+        self.connect()
+
+
+    def connect(self):
+        """Connects to Libre Hardware Monitor. Its WMI namespace only exists while it is running,
+           so this is retried until the monitor is started"""
+        if (wmi is None):
+            self._err ("Error: Libre Hardware Monitor is only supported on Windows.")
+            return
+        try:
+            self.hamon = wmi.WMI(namespace="root\\LibreHardwareMonitor")
+            self.initialized = True
+            self.ok = True
+        except Exception as e:
+            self._err ("Error: Libre Hardware Monitor is not available.\nPlease check if it is installed and running.")
+
+
+    def update(self):
+        # run only if initialization was successful
+        if (self.initialized):
+            # it is possible that at boot time Libre Hardware Monitor starts later than the app,
+            # so the sensor readings will not be available immediately - we need to retry until the monitor is loaded.
+            self.ok = True  # reset error
+
+            # request temperature sensor data, only request what's really needed - this is a slow operation:
+            # the next one line consumes 95% of CPU time during each control cycle.
+            # With a selection WMI only returns the sensors the signals need
+            try:
+                if (self.selection is None):
+                    _sensors = self.hamon.Sensor(["Parent", "Name", "Value"], SensorType="Temperature")
+                elif (len(self.selection.devices) + len(self.selection.keys) > 0):
+                    _sensors = self.hamon.query(self.selectionquery())
+                else:
+                    _sensors = []
+            except Exception as e:
+                # the monitor has been closed, connect() has to be called again once it is back
+                self.initialized = False
+                self.setreadings([])
+                self._err ("Error: Lost connection to Libre Hardware Monitor.\nPlease check if it is running.")
+                return
+
+            self.setreadings([(x.Parent, x.Name, x.Value) for x in _sensors])
+
+
+    def selectionquery(self):
+        """Returns the WQL query of the selected temperature sensors"""
+        terms = ["Parent='{0}'".format(_wqlstring(device)) for device in sorted(self.selection.devices)]
+        terms.extend(["(Parent='{0}' AND Name='{1}')".format(_wqlstring(device), _wqlstring(name))
+                      for device, name in sorted(self.selection.keys)])
+        return "SELECT Parent, Name, Value FROM Sensor WHERE SensorType='Temperature' AND ({0})".format(" OR ".join(terms))
+
+
+    def close(self):
+        if (wmi is not None): CoUninitialize()
+        self.initialized = False
+
+
+
+class HttpSource(SensorSource):
+    """Reads temperatures from the web server of Libre Hardware Monitor (Options > Remote Web Server), which serves
+       the whole sensor tree as data.json. This avoids the WMI query, the most expensive part of a control cycle.
+       The connection is kept alive between samples. Responses are requested conditional (ETag, Last-Modified)
+       and, from a remote server, gzipped; both take effect if the server supports them: an unchanged tree then
+       costs a 304.
+       Only the temperature sensors are parsed out of the JSON. Parent is the hardware identifier taken from
+       SensorId, e.g. "/intelcpu/0", so signals are written the same way as for the WMI source."""
+    NAME = "Libre Hardware Monitor web server"
+    URL = "http://localhost:8085/data.json"
+    TIMEOUT = 2.0     # seconds
+    LOCALHOST = ["localhost", "127.0.0.1", "::1"]    # not worth decompressing
+
+    def __init__(self, url=None):
+        self.url = url if url else self.URL
+        self.connection = None
+        self.connect()
+
+
+    def connect(self):
+        """Connects to the web server and reads the sensor tree once, retried until the server is up"""
+        self.close()
+        parts = urlsplit(self.url)
+        if (parts.scheme != "http" or not parts.hostname):
+            self._err ("Error: Invalid Libre Hardware Monitor URL {0}.".format(self.url))
+            return
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=self.TIMEOUT)
+        self.target = (parts.path or "/data.json") + ("?" + parts.query if parts.query else "")
+        self.headers = {"Accept": "application/json"}
+        if (not parts.hostname in self.LOCALHOST): self.headers["Accept-Encoding"] = "gzip"
+        if (parts.username):
+            credentials = "{0}:{1}".format(parts.username, parts.password or "").encode("utf-8")
+            self.headers["Authorization"] = "Basic " + base64.b64encode(credentials).decode("ascii")
+        self.validators = {}    # If-None-Match, If-Modified-Since of the last tree
+        if (not self.fetch()): return
+        self.initialized = True
+        self.ok = True
+
+
+    def update(self):
+        if (not self.initialized): return
+        self.ok = True
+        if (not self.fetch()):
+            # the server has gone away, connect() has to be called again once it is back
+            self.close()
+            self.setreadings([])
+
+
+    def select(self, selectors):
+        SensorSource.select(self, selectors)
+        self.validators = {}    # the tree has to be read again to apply the selection, even if it has not changed
+
+
+    def fetch(self):
+        """Requests data.json and replaces the sensors, unless the tree has not changed. Returns False on failure"""
+        headers = dict(self.headers)
+        headers.update(self.validators)
+        for attempt in range(0, 2):
+            # a kept-alive connection may have been closed by the server meanwhile: retry once on a new one
+            reused = self.connection.sock is not None
+            try:
+                self.connection.request("GET", self.target, headers=headers)
+                response = self.connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                self.connection.close()
+                if (attempt == 0 and reused): continue
+                self._err ("Error: Libre Hardware Monitor is not available at {0}. {1}".format(self.url, str(e)))
+                return False
+
+        if (response.status == http.client.NOT_MODIFIED):
+            return True
+        if (response.status != http.client.OK):
+            self._err ("Error: Libre Hardware Monitor at {0} answered {1} {2}.".format(self.url, response.status, response.reason))
+            return False
+        try:
+            if (response.getheader("Content-Encoding", "").lower() == "gzip"): body = gzip.decompress(body)
+            sensors = _lhmtemperatures(body.decode("utf-8-sig"))
+        except (OSError, EOFError, ValueError) as e:
+            self._err ("Error: Invalid sensor data from Libre Hardware Monitor at {0}. {1}".format(self.url, str(e)))
+            return False
+        self.validators = {}
+        if (response.getheader("ETag")): self.validators["If-None-Match"] = response.getheader("ETag")
+        if (response.getheader("Last-Modified")): self.validators["If-Modified-Since"] = response.getheader("Last-Modified")
+        self.setreadings(sensors if self.selection is None else self.selection.filter(sensors))
+        return True
+
+
+    def close(self):
+        if (self.connection): self.connection.close()
+        self.initialized = False
+
+
+
+class HwmonSource(SensorSource):
+    """Reads temperatures from the Linux hwmon interface: <root>/hwmon*/temp*_input, in millidegrees.
+       Parent is the driver name (hwmon*/name), sensor name is its label (temp*_label) or "tempN".
+       All files are opened once by connect() and read with os.pread(), so a sample costs one syscall per sensor."""
+    NAME = "hwmon"
+    ROOT = "/sys/class/hwmon"
+
+    # drivers whose sensors make up the default CPU and GPU signals
+    SIGNATURES = {
+        "CPU": ["coretemp", "k10temp", "k8temp", "zenpower", "cpu_thermal"],
+        "GPU": ["amdgpu", "radeon", "nouveau"],
+    }
+
+    def __init__(self, root=None):
+        self.root = root if root else self.ROOT
+        self.inputs = []  # ((parent, name), fd) of every sensor
+        self.files = []   # fd of every selected sensor, in the order of catalog.sourcekeys
+        self.connect()
+
+
+    def connect(self):
+        """Scans the hwmon devices and opens their temperature inputs"""
+        self.close()
+        try:
+            hwmons = sorted(os.listdir(self.root), key=_naturalkey)
+        except OSError as e:
+            self._err ("Error: Cannot read hwmon sensors at {0}. {1}".format(self.root, str(e)))
+            return
+        inputs = []
+        devices = {}
+        for hwmon in hwmons:
+            path = os.path.join(self.root, hwmon)
+            try:
+                entries = sorted(os.listdir(path), key=_naturalkey)
+            except OSError:
+                continue
+            device = _readtext(os.path.join(path, "name")) or hwmon
+            devices[device] = devices.get(device, 0) + 1
+            if (devices[device] > 1): device = "{0} #{1}".format(device, devices[device])    # e.g. several drives
+            for entry in entries:
+                m = re.match(r"temp(\d+)_input$", entry)
+                if (not m): continue
+                name = _readtext(os.path.join(path, "temp{0}_label".format(m.group(1)))) or "temp" + m.group(1)
+                try:
+                    fd = os.open(os.path.join(path, entry), os.O_RDONLY)
+                except OSError:
+                    continue
+                inputs.append(((device, name), fd))
+
+        if (len(inputs) == 0):
+            self._err ("Error: No hwmon temperature sensors found at {0}.".format(self.root))
+            return
+        self.inputs = inputs
+        self.selectinputs()
+        self.initialized = True
+        self.ok = True
+
+
+    def update(self):
+        if (not self.initialized): return
+        self.ok = True
+        slots = self.catalog.slots
+        values = self.values
+        for i in range(0, len(self.files)):
+            try:
+                values[slots[i]] = int(os.pread(self.files[i], 16, 0)) / 1000.0
+            except OSError as e:
+                if (e.errno in (errno.ENODEV, errno.ENXIO, errno.ENOENT)):
+                    # the device has gone away, connect() scans again
+                    self.close()
+                    self._err ("Error: Lost hwmon sensor {0}, {1}.".format(*self.catalog.sourcekeys[i]))
+                    return
+                # some sensors fail to read while the device sleeps (EIO, ENODATA): keep the last value
+            except ValueError:
+                pass
+
+
+    def select(self, selectors):
+        SensorSource.select(self, selectors)
+        if (self.initialized): self.selectinputs()
+
+
+    def selectinputs(self):
+        """Reads the inputs of the selected sensors only from now on"""
+        inputs = [(key, fd) for key, fd in self.inputs if self.selection is None or self.selection.matches(*key)]
+        self.files = [fd for key, fd in inputs]
+        self.setreadings([(key[0], key[1], 0) for key, fd in inputs])
+
+
+    def createSignal(self, signature):
+        """Returns the devices of the drivers known for the signature ("CPU" or "GPU")"""
+        drivers = self.SIGNATURES.get(signature, [])
+        return sorted([device for device in self.catalog.devicenames if device.split(" #")[0] in drivers])
+
+
+    def close(self):
+        for key, fd in self.inputs:
+            os.close(fd)
+        self.inputs = []
+        self.files = []
+        self.initialized = False
+
+
+
+class TextSource(SensorSource):
+    """Base of the sources that read text, one reading per line: "device, sensor, value", "sensor, value",
+       "sensor: value" or just "value". Values may be followed by a unit ("45.5 °C") and are multiplied by
+       the optional "scale" of the settings (e.g. 0.001 for millidegrees). Readings without a device belong to
+       the "device" of the settings, by default the name of the source; those without a name are called tempN"""
+
+    def __init__(self, config):
+        self.device = config.get("device", self.NAME)
+        self.scale = config.get("scale", 1)
+        self.connect()
+
+    def read(self):
+        """Returns the text, None on failure"""
+        return None
+
+    def connect(self):
+        text = self.read()
+        if (text is None): return
+        self.setreadings(self.parse(text))
+        self.initialized = True
+        self.ok = True
+
+    def update(self):
+        if (not self.initialized): return
+        self.ok = True
+        text = self.read()
+        if (text is None):
+            # connect() has to succeed again
+            self.initialized = False
+            self.setreadings([])
+            return
+        readings = self.parse(text)
+        self.setreadings(readings if self.selection is None else self.selection.filter(readings))
+
+    def parse(self, text):
+        """Returns the readings [(device, sensor, value)] of the text"""
+        res = []
+        for line in text.splitlines():
+            fields = [x.strip() for x in line.split(",")]
+            if (len(fields) == 1 and ":" in line):
+                fields = [x.strip() for x in line.split(":", 1)]
+            m = _TEXTVALUE.match(fields[-1])
+            if (not m): continue
+            value = float(m.group(0)) * self.scale
+            if (len(fields) == 1): res.append((self.device, "temp{0}".format(len(res) + 1), value))
+            elif (len(fields) == 2): res.append((self.device, fields[0], value))
+            else: res.append((fields[0], ", ".join(fields[1:-1]), value))
+        return res
+
+
+_TEXTVALUE = re.compile(r"[+-]?\d+(?:\.\d+)?")
+
+
+
+class CommandSource(TextSource):
+    """Runs a command for every sample and reads its output, e.g. of a GPU tool:
+       nvidia-smi --query-gpu=index,name,temperature.gpu --format=csv,noheader"""
+    NAME = "command"
+    TIMEOUT = 10.0    # a command that takes longer is killed, seconds
+
+    def __init__(self, config):
+        command = config.get("command", "")
+        # a list of arguments is run as it is, a command line is split like a shell would except on Windows
+        self.command = shlex.split(command) if isinstance(command, str) and os.name != "nt" else command
+        TextSource.__init__(self, config)
+
+    def read(self):
+        if (len(self.command) == 0):
+            self._err ("Error: No sensor command is set.")
+            return None
+        # no console window pops up on Windows (CREATE_NO_WINDOW)
+        flags = 0x08000000 if os.name == "nt" else 0
+        try:
+            p = subprocess.run(self.command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               timeout=self.TIMEOUT, creationflags=flags)
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            self._err ("Error: Cannot run sensor command {0}. {1}".format(self.command, str(e)))
+            return None
+        if (p.returncode != 0):
+            self._err ("Error: Sensor command {0} has failed with exit code {1}.".format(self.command, p.returncode))
+            return None
+        return p.stdout.decode("utf-8", "replace")
+
+
+
+class FileSource(TextSource):
+    """Reads a text file for every sample, e.g. one a drive temperature daemon keeps up to date"""
+    NAME = "file"
+
+    def __init__(self, config):
+        self.path = config.get("path", "")
+        TextSource.__init__(self, config)
+
+    def read(self):
+        try:
+            with open(self.path, "r") as f:
+                return f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            self._err ("Error: Cannot read sensor file {0}. {1}".format(self.path, str(e)))
+            return None
+
+
+
+class SensorAggregator(SensorSource):
+    """Combines the sources configured as "backends" in the sensors settings into one. Their sensors are named
+       "backend:device, sensor", e.g. "lhm:/intelcpu/0, CPU Core #1", which is how signals refer to them.
+       All backends are read at the same time, each one on its own thread (where it is also created and closed,
+       as WMI requires). A backend that misses its deadline (optional "timeout" in msec) does not hold up
+       the sample: its last readings are used and marked stale, until they are older than MAX_AGE.
+       A backend that fails is reported in warnings and its sensors are UNAVAILABLE, so only the signals that
+       use them are affected; the source as a whole fails only if no backend works."""
+    NAME = "sensor backends"
+    MAX_AGE = 5.0     # seconds
+
+    def __init__(self, config, createsource=createsource):
+        self.backends = [SensorBackend(name, config[name], createsource) for name in sorted(config.keys())]
+        self.generations = None     # catalog generations of the backends the catalog has been built for
+        self.connect()
+
+
+    def connect(self):
+        """Connects the backends that are not connected, waits for them until their deadlines"""
+        self.wait([b.submit(b.connect) for b in self.backends])
+        self.initialized = all([b.initialized for b in self.backends])
+        self.ok = True
+
+
+    def wait(self, futures):
+        """Waits for the futures of all backends, each one until the deadline of its backend at most"""
+        start = time.monotonic()
+        for b, future in zip(self.backends, futures):
+            try:
+                future.result(max(0, start + b.timeout - time.monotonic()))
+            except concurrent.futures.TimeoutError:
+                pass
+
+
+    def select(self, selectors):
+        """Passes the selectors of every backend on, without the "backend:" prefix"""
+        SensorSource.select(self, selectors)
+        for b in self.backends:
+            b.selectors = None if selectors is None else \
+                [x.strip()[len(b.prefix):] for x in selectors if x.strip().startswith(b.prefix)]
+
+
+    def update(self):
+        # a backend whose previous sample is still running is not asked again
+        self.wait([b.sample() for b in self.backends])
+        self.ok = True
+        self.initialized = all([b.initialized for b in self.backends])
+        now = time.monotonic()
+
+        # every backend is taken with its last good snapshot, whose sensors stay in the catalog while the backend fails
+        warnings = []
+        stale = {}
+        unknown = []
+        backends = []
+        snapshots = []
+        available = []
+        for b in self.backends:
+            latest = b.latest
+            if (latest is not None and latest.ok): b.good = latest
+            error = None
+            if (latest is None):
+                error = "No readings from sensor backend {0} yet.".format(b.name)
+            elif (not latest.ok):
+                error = "{0}: {1}".format(b.name, latest.errorMessage)
+            elif (now - latest.timestamp > self.MAX_AGE):
+                error = "No readings from sensor backend {0} for {1:.0f} seconds.".format(b.name, now - latest.timestamp)
+            if (error is not None): warnings.append(error)
+            if (b.good is None):
+                unknown.append(b.prefix)
+                continue
+            if (error is None and not b.future.done()):
+                for device in b.good.catalog.devicenames: stale[b.prefix + device] = b.good.timestamp
+            backends.append(b)
+            snapshots.append(b.good)
+            available.append(error is None)
+        self.stale = stale if len(stale) > 0 else SensorSource.stale
+        self.warnings = warnings
+
+        # the catalog is rebuilt only if a backend has got a new one, otherwise the values are copied into their slots.
+        # It is built from the same snapshots as the values, a backend may publish a new one meanwhile
+        generations = [x.catalog.generation for x in snapshots]
+        if (generations != self.generations):
+            self.catalog = SensorCatalog([(b.prefix + parent, name) for b, snapshot in zip(backends, snapshots)
+                                          for parent, name in snapshot.catalog.keys], unknown)
+            self.values = array("d", bytes(8 * len(self.catalog)))
+            self.generations = generations
+        slots = self.catalog.slots
+        values = self.values
+        i = 0
+        for snapshot, ok in zip(snapshots, available):
+            if (ok):
+                for value in snapshot.values:
+                    values[slots[i]] = value
+                    i += 1
+            else:
+                # the signals that use a sensor of a failed backend are unavailable, the others are not affected
+                for value in snapshot.values:
+                    values[slots[i]] = UNAVAILABLE
+                    i += 1
+
+        # only fails as a whole if no backend works
+        if (not any(available)): self._err("\n".join(warnings) if len(warnings) > 0 else "No sensor backends.")
+
+
+    def createSignal(self, signature):
+        res = []
+        for b in self.backends:
+            if (b.source): res.extend([b.prefix + x for x in b.source.createSignal(signature)])
+        return res
+
+
+    def close(self):
+        for b in self.backends: b.close()
+        self.initialized = False
+
+
+
+class SensorBackend():
+    """A source of a SensorAggregator along with the thread it is created, read and closed on. The thread is
+       a daemon, unlike those of concurrent.futures executors, so that a hung source does not keep the app from exiting"""
+    TIMEOUT = 500     # default deadline of a sample, msec
+
+    def __init__(self, name, config, createsource):
+        self.name = name
+        self.prefix = name + ":"
+        self.config = config
+        self.timeout = config.get("timeout", self.TIMEOUT) / 1000.0
+        self.source = None
+        self.selectors = None   # set by the aggregator, applied on the thread of the backend
+        self.latest = None      # SensorSnapshot of the last complete sample
+        self.good = None        # the last one that was ok, set by the aggregator
+        self.future = None      # of the last sample
+        self.initialized = False
+        self.tasks = queue.Queue()
+        threading.Thread(target=self.work, name="SensorBackend " + name, daemon=True).start()
+        self.submit(self.create, createsource)
+
+    def submit(self, fn, *args):
+        """Runs fn on the thread of the backend, returns its concurrent.futures.Future"""
+        future = concurrent.futures.Future()
+        self.tasks.put((future, fn, args))
+        return future
+
+    def work(self):
+        """threadproc"""
+        while True:
+            future, fn, args = self.tasks.get()
+            if (fn is None): return
+            if (not future.set_running_or_notify_cancel()): continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def create(self, createsource):
+        self.source = createsource({"sensors": self.config})
+        self.initialized = self.source.initialized
+
+    def connect(self):
+        if (self.source is None): return
+        if (not self.source.initialized): self.source.connect()
+        self.initialized = self.source.initialized
+
+    def sample(self):
+        """Starts a sample unless the last one is still running, returns its future"""
+        if (self.future is None or self.future.done()):
+            self.future = self.submit(self.read)
+        return self.future
+
+    def read(self):
+        if (self.source is None): return
+        try:
+            if (self.selectors != self.source.selectors): self.source.select(self.selectors)
+            self.source.update()
+        except Exception as e:
+            # the aggregator reports it as an error of this backend
+            self.source._err("Error: Sensor source {0} has failed. {1}".format(self.source.NAME, repr(e)))
+        self.initialized = self.source.initialized
+        self.latest = self.source.snapshot()
+
+    def close(self):
+        self.submit(lambda: self.source and self.source.close())
+        self.submit(None)
+
+
+
+def _wqlstring(text):
+    """Escapes a string literal of a WQL query"""
+    return text.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def _readtext(path):
+    """Returns the stripped content of a small text file, None if it cannot be read"""
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+_TEMPERATURE = re.compile(r'"Type"\s*:\s*"Temperature"')
+_VALUE = re.compile(r"-?\d+(?:[.,]\d+)?")
+_decoder = json.JSONDecoder()
+
+def _lhmtemperatures(text):
+    """Returns the temperature sensors in data.json of Libre Hardware Monitor. Sensors are the leaves of the tree,
+       so just the objects around "Type": "Temperature" are decoded, which is several times faster than decoding
+       the whole tree. If one of them does not look like a leaf, the whole tree is decoded after all."""
+    res = []
+    for m in _TEMPERATURE.finditer(text):
+        start = text.rfind("{", 0, m.start())
+        try:
+            node = _decoder.raw_decode(text, start)[0] if (start >= 0) else None
+        except ValueError:
+            node = None
+        if (not isinstance(node, dict) or node.get("Type") != "Temperature" or node.get("Children")):
+            tree = json.loads(text, object_hook=_lhmnode)
+            return tree if isinstance(tree, list) else []
+        res.extend(_lhmnode(node))
+    return res
+
+
+def _lhmnode(node):
+    """object_hook for data.json of Libre Hardware Monitor: a temperature sensor becomes [(parent, name, value)], any other node
+       the list of sensors found below it, so the tree is reduced to the temperatures while it is parsed"""
+    if (node.get("Type") == "Temperature" and "SensorId" in node):
+        parent = node["SensorId"].rsplit("/temperature/", 1)[0]
+        return [(parent, node.get("Text", ""), _lhmvalue(node.get("RawValue", node.get("Value"))))]
+    res = []
+    for child in node.get("Children", []):
+        if (isinstance(child, list)): res.extend(child)
+    return res
+
+
+def _lhmvalue(value):
+    """Reads a sensor value, which is either a number or formatted text like "45.5 °C" or "45,5 °C" """
+    if (isinstance(value, (int, float))): return value
+    m = _VALUE.search(value or "")
+    return float(m.group(0).replace(",", ".")) if m else 0
+
+
+def _naturalkey(text):
+    """Sorts hwmon10 after hwmon9 and temp10_input after temp9_input"""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", text)]
+
+
+
+class Sensor():
+    """A sensor of a SensorSnapshot: parent, name and value of one of its slots"""
+    __slots__ = ("snapshot", "slot")
+
+    def __init__(self, snapshot, slot):
+        self.snapshot = snapshot
+        self.slot = slot
+
+    @property
+    def parent(self):
+        return self.snapshot.catalog.keys[self.slot][0]
+
+    @property
+    def name(self):
+        return self.snapshot.catalog.keys[self.slot][1]
+
+    @property
+    def value(self):
+        return self.snapshot.values[self.slot]
+
+    @property
+    def stale(self):
+        """The timestamp of the reading if it is older than the snapshot (see SensorAggregator), None otherwise"""
+        return self.snapshot.stale.get(self.parent)
+
+    def isMatch(self, sig):
+        return self.name.find(sig) >= 0
+
+    def __repr__(self):
+        return "<{0}, {1}, {2}>".format(self.parent, self.name, self.value)
+
+
+
+class Signal():
+    """Calculates and holds signal value"""
+    name = ""
+    fn = ""
+    sensornames = []
+    slots = []          # sensors compiled to slots of a SensorCatalog
+    generation = -1     # the catalog generation slots have been compiled for
+    incomplete = False  # some of the sensors are not known yet, see SensorCatalog.incomplete()
+    available = True    # False if a sensor of the signal has no current reading
+    value = 0
+    min = 0
+    max = 0
+
+    def __init__(self, name, fn, sensors):
+        self.name = name
+        self.fn = fn
+        self.sensors = sensors
+
+    def update(self, value):
+        self.value = value
+        if (self.min == 0): self.min = value
+        if (self.max == 0): self.max = value
+        if (value < self.min): self.min = value
+        if (value > self.max): self.max = value
@@ -1,16 +1,40 @@
 import sys, os, inspect
 import datetime
 import threading
-import winreg
 import json
+try:
+    import winreg
+except ImportError:
+    winreg = None    # Windows only: elsewhere there is no auto-start to manage
 from collections import OrderedDict
 
 from prettyjson import prettyjson
-from hardware import list_comports, NZXTGrid, Hamon
+from hardware import list_comports, NZXTGrid
+from sensors import createsource, SOURCES
+from discovery import discover, PORT_CACHE
 from util import StrStream
 
 
 
+def gridports(settings):
+    """Returns the list of Grid ports from settings, fan1..fan6 belong to the first Grid, fan7..fan12 to the second one, etc."""
+    port = settings["grid"]["port"]
+    if isinstance(port, list): return port
+    return [port]
+
+
+def gridcaptures(settings):
+    """Returns the trace file for each Grid (None if traffic is not captured). With several Grids,
+       the file name gets the number of the Grid: trace.bin -> trace1.bin, trace2.bin etc."""
+    ports = gridports(settings)
+    path = settings["grid"].get("capture")
+    if (not path): return [None] * len(ports)
+    if (len(ports) == 1): return [path]
+    root, ext = os.path.splitext(path)
+    return ["{0}{1}{2}".format(root, i+1, ext) for i in range(0, len(ports))]
+
+
+
 class AppSettings():
     """ Holds application settings, saves/read them from file, provides default settings if the file is missing"""
     scriptpath = ""    
@@ -67,7 +91,7 @@ class AppSettings():
     def __init__(self):
         """Loads settings from file, if file does not exist, inits with default settings and saves file"""
         self.scriptpath = self.get_script_dir()
-        self.path = self.scriptpath + "\\pygrid.json"
+        self.path = os.path.join(self.scriptpath, "pygrid.json")
         self.ok = True
         print ("Loading settings from {0}".format(self.path))
         useDefault = False
@@ -114,35 +138,39 @@ class AppSettings():
             port = s["grid"]["port"]
             if (port == "%PORT%"):
                 port = "N/A"
-                # select the first COM port from the list. Assume this is NZXT Grid
-                ports = list_comports()
+                # select the port where Grid answers the handshake. If none does (e.g. Grid is unplugged),
+                # select the first COM port from the list and assume this is NZXT Grid
+                ports = discover(self.portcache())
                 if len(ports)>0:
-                    device, description, hardwareID = ports[0]
-                    port = device
+                    port = ports[0]
+                else:
+                    ports = list_comports()
+                    if len(ports)>0:
+                        device, description, hardwareID = ports[0]
+                        port = device
                 s["grid"]["port"] = port
                 save = True
 
             # add signals:
             signals = s["signals"]
             if len(signals) == 0:
-                hamon = Hamon()
-                hamon.update()
+                source = createsource(s)     # a new source reads all sensors
+                source.update()
                 
-                if hamon.ok:
-                    sensors = hamon.createSignal("CPU")
+                if source.ok:
+                    sensors = source.createSignal("CPU")
                     signal = OrderedDict()
                     signal["fn"] = "max"
                     signal["sensors"] = sensors
                     signals["cpu"] = signal
 
-                    sensors = hamon.createSignal("GPU")
+                    sensors = source.createSignal("GPU")
                     signal = OrderedDict()
                     signal["fn"] = "max"
                     signal["sensors"] = sensors
                     signals["gpu"] = signal
-
-                    hamon.close()
                     save = True
+                source.close()
 
 
         # make new settings current if all checks are OK
@@ -150,10 +178,7 @@ class AppSettings():
             with self.lock:
                 self.settings = s
                 self.timestamp = datetime.datetime.now()
-            if (save):
-                jsontxt = self.getjson()    # re-render from dictionary
-                with open(self.path, "w") as f:
-                    f.write(jsontxt)
+            if (save): self.save()
 
         if (self.ok):
             startwithwindows = self.settings["app"]["startwithwindows"]
@@ -168,16 +193,43 @@ class AppSettings():
             self.require(_app, "app", "startminimized", bool)
             self.require(_app, "app", "closetotray", bool)
 
+        numgrids = 1
         if self.require(s, "root", "grid", dict):
             _grid = s["grid"]
-            self.require(_grid, "grid", "port", str)
+            # a single port or a list of ports when there are several Grids
+            if "port" in _grid and isinstance(_grid["port"], list):
+                for p in range (0, len(_grid["port"])):
+                    self.require(_grid["port"], "grid.port", p, str)
+                if len(_grid["port"]) == 0: self._err("The field 'grid.port' must list at least one port")
+                numgrids = max(1, len(_grid["port"]))
+            else:
+                self.require(_grid, "grid", "port", str)
+            if "pipelined" in _grid: self.require(_grid, "grid", "pipelined", bool)   # optional, off by default
+            if "pollbudget" in _grid: self.require(_grid, "grid", "pollbudget", int)  # optional, msec
+            if "capture" in _grid: self.require(_grid, "grid", "capture", str)        # optional, trace file
+            if "muxport" in _grid: self.require(_grid, "grid", "muxport", int)        # optional, TCP port
+
+        if "sensors" in s and self.require(s, "root", "sensors", dict):              # optional, default sensor source
+            _sensors = s["sensors"]
+            if "backends" in _sensors and self.require(_sensors, "sensors", "backends", dict):
+                for name in _sensors["backends"].keys():
+                    if (name == "" or ":" in name or "," in name):
+                        self._err("sensors.backends: '{0}' is not a valid backend name".format(name))
+                    elif self.require(_sensors["backends"], "sensors.backends", name, dict):
+                        if ("backends" in _sensors["backends"][name]):
+                            self._err("sensors.backends['{0}'] cannot have backends of its own".format(name))
+                        self.requiresource(_sensors["backends"][name], "sensors.backends['{0}']".format(name))
+            else:
+                self.requiresource(_sensors, "sensors")
+            if "process" in _sensors: self.require(_sensors, "sensors", "process", bool)
+            if "memorylimit" in _sensors: self.require(_sensors, "sensors", "memorylimit", int)
 
         if self.require(s, "root", "policy", dict):
             _policy = s["policy"]
             self.require(_policy, "policy", "hysteresis", int)
             self.require(_policy, "policy", "movingaverage", int)
 
-            for f in range (1, NZXTGrid.NUM_FANS+1):
+            for f in range (1, NZXTGrid.NUM_FANS*numgrids+1):
                 fanid = "fan{}".format(f)
                 if self.require(_policy, "policy", fanid, dict):
                     _fan = _policy[fanid]
@@ -228,6 +280,23 @@ class AppSettings():
 
 
 
+    def requiresource(self, obj, dictname):
+        """Validates the settings of a sensor source"""
+        if "source" in obj and self.require(obj, dictname, "source", str):
+            if (not obj["source"] in SOURCES):
+                self._err("{0}.source must be one of: {1}".format(dictname, ", ".join(SOURCES)))
+            # these sources have nothing to read without it
+            if (obj["source"] == "command" and self.require(obj, dictname, "command", (str, list))):
+                if (len(obj["command"]) == 0): self._err("The field '{0}[command]' is empty".format(dictname))
+            if (obj["source"] == "file" and self.require(obj, dictname, "path", str)):
+                if (obj["path"] == ""): self._err("The field '{0}[path]' is empty".format(dictname))
+        for key in ["path", "url", "device"]:
+            if key in obj: self.require(obj, dictname, key, str)
+        for key in ["timeout", "scale"]:
+            if key in obj and (isinstance(obj[key], bool) or not isinstance(obj[key], (int, float))):
+                self._err("The field '{0}[{1}]' is expected to be a number".format(dictname, key))
+
+
     def require(self, obj, dictname, key, valuetype):
         res = True
         keyexists = False
@@ -240,7 +309,8 @@ class AppSettings():
         else:
             item = obj[key]
             if not isinstance(item, valuetype):
-                self._err("The field '{0}[{1}]' is expected to be of type '{2}'".format(dictname, str(key), str(valuetype.__name__)))
+                typename = " or ".join([t.__name__ for t in valuetype]) if isinstance(valuetype, tuple) else valuetype.__name__
+                self._err("The field '{0}[{1}]' is expected to be of type '{2}'".format(dictname, str(key), typename))
                 res = False
         return res
 
@@ -248,6 +318,31 @@ class AppSettings():
         return prettyjson(self.settings, maxlinelength=45)
 
 
+    def save(self):
+        jsontxt = self.getjson()    # re-render from dictionary
+        with open(self.path, "w") as f:
+            f.write(jsontxt)
+
+
+    def portcache(self):
+        """Returns the path of the file the USB devices of the Grid ports are remembered in, see discovery"""
+        return os.path.join(self.scriptpath, PORT_CACHE)
+
+
+    def relocate(self, index, port):
+        """Changes the port of a Grid that has been found on another port and saves the settings.
+           The caller holds the lock; the controller picks the change up like any other settings update"""
+        if isinstance(self.settings["grid"]["port"], list):
+            self.settings["grid"]["port"][index] = port
+        else:
+            self.settings["grid"]["port"] = port
+        self.timestamp = datetime.datetime.now()
+        try:
+            self.save()
+        except Exception as e:
+            print ("Failed to save {0}. {1}".format(self.path, str(e)))
+
+
 
 
     """Set application to auto-start with Windows by making appropriate registry changes:"""
@@ -256,6 +351,7 @@ class AppSettings():
     REG_VALUE = "pygrid"
 
     def updateAutoStart(self, startwithwindows):
+        if (winreg is None): return
         if (startwithwindows): 
             self.windowsStartAdd()
         else: 
@@ -264,7 +360,7 @@ class AppSettings():
 
     # https://stackoverflow.com/questions/15128225/python-script-to-read-and-write-a-path-to-registry
     def windowsStartAdd(self):
-        exepath = self.scriptpath + "\\pygrid.exe"
+        exepath = os.path.join(self.scriptpath, "pygrid.exe")
         key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, self.REG_PATH, 0, winreg.KEY_READ | winreg.KEY_WRITE)
         registryNeedsUpdate = True
         try:
@@ -1,4 +1,6 @@
 import sys
+import time
+import random
 import datetime
 
 
@@ -68,3 +70,54 @@ class timediff():
     def __exit__(self, ext_type, exc_value, traceback):
         self.now()
 
+
+
+class ReconnectPolicy():
+    """Decides when to retry a device that has gone away (Grid unplugged, Libre Hardware Monitor not running).
+       Works as a circuit breaker: the circuit is closed while the device works. A failed reconnect opens it,
+       and no attempt is made until the backoff delay expires; then a single attempt is let through (half-open).
+       The delay doubles with every failed attempt up to MAX_DELAY, with random jitter so that several devices
+       do not retry in lockstep. kick() allows the next attempt right away, e.g. on hotplug or a settings change."""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    MIN_DELAY = 1.0     # delay after the first failed attempt, seconds
+    MAX_DELAY = 60.0
+    JITTER = 0.2        # the delay is shortened by up to 20%
+
+    state = CLOSED
+    failures = 0        # nr of failed attempts in a row
+    nextattempt = 0     # time.monotonic() when the next attempt is allowed
+
+    def __init__(self):
+        self.random = random.Random()
+
+    def ready(self):
+        """Returns True if a reconnect attempt may be made now"""
+        if (self.state == self.OPEN):
+            if (time.monotonic() < self.nextattempt): return False
+            self.state = self.HALF_OPEN
+        return True
+
+    def result(self, ok):
+        """Records the outcome of a reconnect attempt"""
+        if (ok):
+            self.state = self.CLOSED
+            self.failures = 0
+            return
+        self.failures += 1
+        delay = min(self.MAX_DELAY, self.MIN_DELAY * 2 ** (self.failures - 1))
+        delay *= 1 - self.JITTER * self.random.random()
+        self.nextattempt = time.monotonic() + delay
+        self.state = self.OPEN
+
+    def kick(self):
+        self.nextattempt = 0
+
+    def status(self):
+        """Describes the state for the UI"""
+        if (self.state == self.CLOSED): return "Connected."
+        if (self.state == self.HALF_OPEN): return "Reconnecting..."
+        return "Failed attempts: {0}, next attempt in {1:.0f} sec.".format(
+            self.failures, max(0, self.nextattempt - time.monotonic()))